@@ -0,0 +1,725 @@
+"""
+    Offline benchmark of the bot commands.
+
+    Local fake servers stand in for Float v3, the Salesforce REST/SOQL API and the Slack
+    Web API, every https request of the process is routed to them. The fakes are filled
+    with synthetic data (N projects x M tasks x K people) and can add latency, limit the
+    page sizes and answer with rate limit errors. For every command the wall time, the
+    peak memory and the number of API calls per endpoint are reported.
+
+    python benchmark.py --projects 300 --tasks 10 --people 50 --float-latency 80
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json --tolerance 0.25
+"""
+from __future__ import print_function
+
+import os
+import sys
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import datetime, date, timedelta
+from collections import OrderedDict
+
+import requests
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, urlunsplit, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, urlunsplit, parse_qs
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+SALESFORCE_HOST = "bench.my.salesforce.com"
+FLOAT_HOST = "api.float.com"
+SLACK_HOST = "slack.com"
+SESSION_ID = "BENCHSESSION"
+CHANNEL = "CBENCH"
+OWNERS = ['Ashley Tuley', 'Brian DeHetre', 'Carlos Rojas', 'Chad Ready'] # project owners known to projectplan
+TASK_NAMES = ['Go Live', 'Enduser training', 'Remote Enduser training', 'One on One',
+              'Paid Time Off', 'Project kickoff', 'Data migration']
+MILESTONE_NAME = 'Implementation and Training'
+SF_MAX_CHUNKS = 10 # sObject type runs Salesforce accepts in one collection request
+DEFAULT_COMMANDS = ['sync {session} full', 'sync {session}', 'report', 'projectplan {session} 2000-01-01']
+
+
+class RateLimiter:
+    """
+        token bucket per key, rate requests per second with a burst of rate
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """
+            Returns 0 if the request may pass, otherwise the seconds until it would
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            tokens, updated = self.buckets.get(key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def headers(self, key):
+        """
+            X-RateLimit headers like Float sends them, per minute
+        """
+        if not self.rate:
+            return {}
+        with self.lock:
+            tokens = self.buckets.get(key, (self.rate, 0))[0]
+        return {'X-RateLimit-Limit': str(int(self.rate * 60)), 'X-RateLimit-Remaining': str(int(tokens * 60))}
+
+
+class FakeBackend:
+    """
+        shared behaviour of the fakes: latency, rate limiting and per endpoint call counters
+    """
+    name = None
+
+    def __init__(self, latency=0, rate=0):
+        self.latency = latency / 1000.0
+        self.limiter = RateLimiter(rate)
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = {}
+        return calls
+
+    def handle(self, method, path, query, headers, body):
+        """
+            Returns (status, headers, body) for one request
+        """
+        raise NotImplementedError
+
+
+class FakeFloat(FakeBackend):
+    """
+        Float v3 people, projects and tasks with X-Pagination headers
+    """
+    name = 'float'
+
+    def __init__(self, data, max_page_size=200, **kwargs):
+        FakeBackend.__init__(self, **kwargs)
+        self.data = data
+        self.max_page_size = max_page_size
+
+    def handle(self, method, path, query, headers, body):
+        path = re.sub(r'^/v3', '', path)
+        endpoint = re.sub(r'/\d+', '/<id>', path)
+        self.count('{} {}'.format(method, endpoint))
+        wait = self.limiter.allow('float')
+        limit_headers = self.limiter.headers('float')
+        if wait:
+            self.count('429')
+            return 429, dict(limit_headers, **{'Retry-After': '{:.2f}'.format(wait)}), b''
+
+        m = re.match(r'^/(people|projects|tasks)(?:/(\d+))?/?$', path)
+        if m is None:
+            return 404, {}, b''
+        records = self.data[m.group(1)]
+        if m.group(2):
+            record = records.get(int(m.group(2)))
+            if record is None:
+                return 404, {}, b''
+            return 200, limit_headers, json.dumps(record).encode('utf-8')
+
+        records = list(records.values())
+        if m.group(1) == 'tasks':
+            records = self.filter_tasks(records, query)
+        per_page = min(int(query.get('per-page', [50])[0]), self.max_page_size)
+        page = int(query.get('page', [1])[0])
+        page_count = max(1, (len(records) + per_page - 1) // per_page)
+        return 200, dict(limit_headers, **{'X-Pagination-Page-Count': str(page_count),
+                                           'X-Pagination-Total-Count': str(len(records))}), \
+            json.dumps(records[(page - 1) * per_page:page * per_page]).encode('utf-8')
+
+    def filter_tasks(self, tasks, query):
+        if 'project_id' in query:
+            project_id = int(query['project_id'][0])
+            tasks = [task for task in tasks if task['project_id'] == project_id]
+        if 'start_date' in query:
+            tasks = [task for task in tasks if task['end_date'] >= query['start_date'][0]]
+        if 'end_date' in query:
+            tasks = [task for task in tasks if task['start_date'] <= query['end_date'][0]]
+        if 'modified_since' in query:
+            tasks = [task for task in tasks if task['modified'] >= query['modified_since'][0]]
+        return tasks
+
+
+class SoqlQuery:
+    """
+        the subset of SOQL the bot sends: select <fields> from <object> where <conditions
+        joined with and> limit <n>, with =, !=, <, >, like and in, compared case-insensitively
+    """
+    TOKEN = re.compile(r"\s*(?:('(?:[^'\\]|\\.)*')|(<=|>=|!=|=|<|>|\(|\)|,)|([^\s=<>!(),']+))")
+
+    def __init__(self, soql):
+        self.tokens = []
+        position = 0
+        soql = soql.strip()
+        while position < len(soql):
+            m = self.TOKEN.match(soql, position)
+            if m is None or m.end() == position:
+                raise ValueError('Unsupported SOQL near: {}'.format(soql[position:position + 30]))
+            string, symbol, word = m.groups()
+            if string is not None:
+                self.tokens.append(('value', re.sub(r"\\(.)", r"\1", string[1:-1])))
+            elif symbol is not None:
+                self.tokens.append(('symbol', symbol))
+            elif word is not None:
+                self.tokens.append(('word', word))
+            position = m.end()
+        self.position = 0
+        self.parse()
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position = self.position + 1
+        return token
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def parse(self):
+        self.fields = []
+        self.conditions = []
+        self.limit = None
+        assert self.next()[1].lower() == 'select'
+        while True:
+            kind, token = self.next()
+            if token.lower() == 'from':
+                break
+            if token != ',':
+                self.fields.append(token)
+        self.sobject = self.next()[1]
+        while self.peek()[1] is not None:
+            kind, token = self.next()
+            if token.lower() == 'limit':
+                self.limit = int(self.next()[1])
+            elif token.lower() not in ('where', 'and', '(', ')'):
+                self.conditions.append(self.parse_condition(token))
+
+    def parse_condition(self, field):
+        kind, operator = self.next()
+        operator = operator.lower()
+        if operator == 'in':
+            assert self.next()[1] == '('
+            values = []
+            while True:
+                kind, token = self.next()
+                if token == ')':
+                    break
+                if token != ',':
+                    values.append(self.literal(kind, token))
+            return field, operator, values
+        kind, token = self.next()
+        return field, operator, self.literal(kind, token)
+
+    def literal(self, kind, token):
+        if kind == 'value':
+            return token
+        if token.lower() in ('true', 'false'):
+            return token.lower() == 'true'
+        if token.lower() == 'null':
+            return None
+        return token
+
+    def matches(self, record):
+        for field, operator, value in self.conditions:
+            current = self.get_field(record, field)
+            if isinstance(current, string_types):
+                current = current.lower()
+            if operator == 'in':
+                if current not in [item.lower() if isinstance(item, string_types) else item for item in value]:
+                    return False
+                continue
+            if isinstance(value, string_types):
+                value = value.lower()
+            if operator == 'like':
+                pattern = '^' + re.escape(value).replace('\\%', '.*').replace('%', '.*').replace('\\_', '.') + '$'
+                if current is None or re.match(pattern, current) is None:
+                    return False
+            elif operator == '=' and current != value:
+                return False
+            elif operator == '!=' and current == value:
+                return False
+            elif operator in ('<', '>', '<=', '>='):
+                if current is None or not {'<': current < value, '>': current > value,
+                                           '<=': current <= value, '>=': current >= value}[operator]:
+                    return False
+        return True
+
+    def get_field(self, record, field):
+        value = record
+        for part in field.split('.'):
+            if value is None:
+                return None
+            value = value.get(part)
+        return value
+
+    def project(self, record):
+        result = OrderedDict([('attributes', {'type': self.sobject})])
+        for field in self.fields:
+            parts = field.split('.')
+            target = result
+            source = record
+            for part in parts[:-1]:
+                source = (source or {}).get(part)
+                target = target.setdefault(part, OrderedDict([('attributes', {'type': part})]))
+            target[parts[-1]] = (source or {}).get(parts[-1])
+        return result
+
+
+class FakeSalesforce(FakeBackend):
+    """
+        Salesforce REST: SOQL queries with nextRecordsUrl paging, limits, describe,
+        sObject Collections writes and attachment bodies
+    """
+    name = 'salesforce'
+
+    def __init__(self, data, batch_size=2000, daily_limit=1000000, **kwargs):
+        FakeBackend.__init__(self, **kwargs)
+        self.data = data
+        self.batch_size = batch_size
+        self.daily_limit = daily_limit
+        self.used = 0
+        self.cursors = {}
+        self.write_lock = threading.Lock()
+
+    def handle(self, method, path, query, headers, body):
+        with self.lock:
+            self.used = self.used + 1
+        limit_headers = {'Sforce-Limit-Info': 'api-usage={}/{}'.format(self.used, self.daily_limit)}
+        wait = self.limiter.allow('salesforce')
+        if wait:
+            self.count('403 REQUEST_LIMIT_EXCEEDED')
+            return 403, limit_headers, json.dumps([{
+                'errorCode': 'REQUEST_LIMIT_EXCEEDED', 'message': 'TotalRequests Limit exceeded.'}]).encode('utf-8')
+
+        if headers.get('Authorization') != 'Bearer {}'.format(SESSION_ID):
+            self.count('401')
+            return 401, limit_headers, json.dumps([{
+                'errorCode': 'INVALID_SESSION_ID', 'message': 'Session expired or invalid'}]).encode('utf-8')
+
+        path = re.sub(r'^/services/data/v[\d.]+', '', path)
+        if path.startswith('/query'):
+            status, body = self.query(path, query)
+        elif path.rstrip('/') == '/limits':
+            self.count('GET limits')
+            status, body = 200, {'DailyApiRequests': {'Max': self.daily_limit,
+                                                      'Remaining': self.daily_limit - self.used}}
+        elif path.rstrip('/') == '/sobjects':
+            self.count('GET describe')
+            status, body = 200, {'sobjects': [{'labelPlural': 'Projects', 'name': 'pse__Proj__c'}]}
+        elif path.rstrip('/') == '/composite/sobjects':
+            self.count('{} composite/sobjects'.format(method))
+            payload = json.loads(body.decode('utf-8'))
+            if self.type_chunks(payload) > SF_MAX_CHUNKS:
+                self.count('400 too many chunks')
+                status, body = 400, [{'errorCode': 'INVALID_BATCH_REQUEST', 'message': 'Cannot have more than '
+                                      '{} chunks in a single operation'.format(SF_MAX_CHUNKS)}]
+            else:
+                status, body = 200, self.write(method, payload)
+        elif re.match(r'^/sobjects/Attachment/[^/]+/body$', path):
+            self.count('GET attachment body')
+            attachment = self.data['Attachment'].get(path.split('/')[3])
+            if attachment is None:
+                return 404, limit_headers, b''
+            return 200, dict(limit_headers, **{'Content-Type': 'application/octet-stream'}), \
+                b'x' * attachment['BodyLength']
+        else:
+            self.count('{} {}'.format(method, path))
+            status, body = 404, [{'errorCode': 'NOT_FOUND', 'message': path}]
+        return status, dict(limit_headers, **{'Content-Type': 'application/json'}), json.dumps(body).encode('utf-8')
+
+    def query(self, path, query):
+        m = re.match(r'^/query/([^/]+)-(\d+)$', path)
+        if m is not None:
+            self.count('GET query more')
+            cursor = m.group(1)
+            records = self.cursors.get(cursor, [])
+            offset = int(m.group(2))
+        else:
+            try:
+                soql = SoqlQuery(query['q'][0])
+            except (KeyError, ValueError, AssertionError, IndexError) as e:
+                self.count('GET query MALFORMED_QUERY')
+                return 400, [{'errorCode': 'MALFORMED_QUERY', 'message': str(e)}]
+            self.count('GET query {}'.format(soql.sobject))
+            with self.write_lock:
+                records = [soql.project(record) for record in self.data.get(soql.sobject, {}).values()
+                           if soql.matches(record)]
+            if soql.limit is not None:
+                records = records[:soql.limit]
+            offset = 0
+            cursor = None
+            if len(records) > self.batch_size:
+                cursor = '01g{}'.format(random.randint(10 ** 8, 10 ** 9))
+                self.cursors[cursor] = records
+
+        page = records[offset:offset + self.batch_size]
+        result = {'totalSize': len(records), 'done': offset + self.batch_size >= len(records), 'records': page}
+        if not result['done']:
+            result['nextRecordsUrl'] = '/services/data/v38.0/query/{}-{}'.format(
+                cursor, offset + self.batch_size)
+        return 200, result
+
+    def type_chunks(self, payload):
+        # every run of records of the same sObject type is one chunk
+        types = [record.get('attributes', {}).get('type') for record in payload.get('records', [])]
+        return len([i for i in range(len(types)) if i == 0 or types[i] != types[i - 1]])
+
+    def write(self, method, payload):
+        results = []
+        with self.write_lock:
+            for record in payload.get('records', []):
+                sobject = record.get('attributes', {}).get('type')
+                # field names are case-insensitive, the bot sends the record id as "id"
+                fields = dict(('Id' if key.lower() == 'id' else key, value)
+                              for key, value in record.items() if key != 'attributes')
+                table = self.data.setdefault(sobject, OrderedDict())
+                if method == 'POST':
+                    record_id = 'a0B{:012d}'.format(len(table) + 1)
+                    fields['Id'] = record_id
+                    table[record_id] = fields
+                elif fields.get('Id') in table:
+                    record_id = fields['Id']
+                    table[record_id].update(fields)
+                else:
+                    results.append({'id': fields.get('Id'), 'success': False, 'errors': [{
+                        'statusCode': 'ENTITY_IS_DELETED', 'message': 'entity is deleted', 'fields': []}]})
+                    continue
+                results.append({'id': record_id, 'success': True, 'errors': []})
+        return results
+
+
+class FakeSlack(FakeBackend):
+    """
+        Slack Web API methods used by the bot; chat.postMessage is rate limited per channel
+    """
+    name = 'slack'
+
+    def __init__(self, **kwargs):
+        FakeBackend.__init__(self, **kwargs)
+        self.ts = 0
+
+    def handle(self, method, path, query, headers, body):
+        api_method = path.split('/')[-1]
+        self.count('POST {}'.format(api_method))
+        params = parse_qs(body.decode('utf-8', 'ignore')) if api_method != 'files.upload' else {}
+        channel = params.get('channel', [CHANNEL])[0]
+        if api_method == 'chat.postMessage':
+            wait = self.limiter.allow(channel)
+            if wait:
+                self.count('429')
+                return 429, {'Retry-After': str(int(wait) + 1)}, json.dumps(
+                    {'ok': False, 'error': 'ratelimited'}).encode('utf-8')
+
+        with self.lock:
+            self.ts = self.ts + 1
+            ts = '{}.{:06d}'.format(int(time.time()), self.ts)
+        result = {'ok': True, 'ts': ts, 'channel': channel}
+        if api_method == 'auth.test':
+            result['user_id'] = 'UBENCH'
+        return 200, {'Content-Type': 'application/json'}, json.dumps(result).encode('utf-8')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def handle_any(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            parts = urlsplit(self.path)
+            if backend.latency:
+                time.sleep(backend.latency)
+            status, headers, response = backend.handle(
+                self.command, parts.path, parse_qs(parts.query), self.headers, body)
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        do_GET = do_POST = do_PATCH = do_DELETE = handle_any
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class Router:
+    """
+        sends every https request of the process to the local fake of its host over plain http.
+        Requests to any other host fail, so a benchmark can never reach a live API.
+    """
+    def __init__(self):
+        self.ports = {}
+        self.servers = []
+
+    def serve(self, host, backend):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(backend))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.ports[host] = server.server_address[1]
+        self.servers.append(server)
+
+    def rewrite(self, url):
+        parts = urlsplit(url)
+        if parts.hostname == '127.0.0.1':
+            return url
+        port = self.ports.get(parts.hostname)
+        if port is None:
+            raise requests.exceptions.ConnectionError('{} is not faked by the benchmark'.format(parts.hostname))
+        return urlunsplit(('http', '127.0.0.1:{}'.format(port), parts.path, parts.query, ''))
+
+    def install(self):
+        send = requests.adapters.HTTPAdapter.send
+        router = self
+
+        def routed_send(adapter, request, **kwargs):
+            request.url = router.rewrite(request.url)
+            return send(adapter, request, **kwargs)
+        requests.adapters.HTTPAdapter.send = routed_send
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def generate_data(projects, tasks, people, attachment_size, seed):
+    """
+        Float and Salesforce records that match each other: every Float project PR-<id> has a
+        Salesforce project with a milestone and one project task per Float task name,
+        every fifth Float person is an inactive Salesforce resource that gets assigned as an
+        external resource, every seventh is inactive in Float, every third project has a plan
+    """
+    rnd = random.Random(seed)
+    today = date.today()
+    modified = (datetime.utcnow() - timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S")
+
+    float_people = OrderedDict()
+    contacts = OrderedDict()
+    for i in range(1, people + 1):
+        name = OWNERS[i - 1] if i <= len(OWNERS) else 'Person {}'.format(i)
+        float_people[i] = {'people_id': i, 'name': name, 'active': 0 if i % 7 == 0 else 1}
+        contact_id = '003{:012d}'.format(i)
+        contacts[contact_id] = {'Id': contact_id, 'Name': name, 'pse__Is_Resource__c': True,
+                                'pse__Is_Resource_Active__c': i % 5 != 0}
+    # projectplan only looks at projects of active owners
+    owners = [contact for contact in list(contacts.values())[:len(OWNERS)] if contact['pse__Is_Resource_Active__c']]
+    owners = owners or list(contacts.values())
+
+    float_projects = OrderedDict()
+    float_tasks = OrderedDict()
+    sf_projects = OrderedDict()
+    milestones = OrderedDict()
+    project_tasks = OrderedDict()
+    attachments = OrderedDict()
+    task_id = 0
+    for i in range(1, projects + 1):
+        pr_id = 100000 + i
+        name = '{}Project PR-{}'.format('ATLAS ' if i % 3 == 0 else '', pr_id)
+        float_projects[i] = {'project_id': i, 'name': name, 'tags': []}
+        sf_project_id = 'a0P{:012d}'.format(i)
+        owner = owners[i % len(owners)]
+        sf_projects[sf_project_id] = {'Id': sf_project_id, 'Name': name, 'pse__Project_ID__c': 'PR-{}'.format(pr_id),
+                                      'Assigned_Owner__c': owner['Id'], 'Assigned_Owner__r': owner}
+        milestone_id = 'a0M{:012d}'.format(i)
+        milestones[milestone_id] = {'Id': milestone_id, 'Name': MILESTONE_NAME, 'pse__Project__c': sf_project_id}
+        if i % 3 == 0:
+            attachment_id = '00P{:012d}'.format(i)
+            attachments[attachment_id] = {'Id': attachment_id, 'Name': 'plan-{}.xlsx'.format(pr_id),
+                                          'ParentId': sf_project_id, 'BodyLength': attachment_size,
+                                          'LastModifiedDate': '{}T10:00:00.000+0000'.format(today.isoformat())}
+
+        for j in range(tasks):
+            task_id = task_id + 1
+            start = today + timedelta(days=rnd.randint(-45, 45))
+            task_name = '{} {}'.format(TASK_NAMES[j % len(TASK_NAMES)], j)
+            float_tasks[task_id] = {'task_id': task_id, 'project_id': i, 'people_id': rnd.randint(1, people),
+                                    'name': task_name, 'start_date': start.isoformat(),
+                                    'end_date': (start + timedelta(days=rnd.randint(0, 4))).isoformat(),
+                                    'hours': 8, 'modified': modified}
+            sf_task_id = 'a0T{:012d}'.format(task_id)
+            project_tasks[sf_task_id] = {'Id': sf_task_id, 'Name': task_name, 'pse__Project__c': sf_project_id,
+                                         'pse__Milestone__c': milestone_id, 'pse__Assigned_Resources__c': None,
+                                         'pse__Assigned_Resources_Long__c': None,
+                                         'pse__Start_Date_Time__c': None, 'pse__End_Date_Time__c': None}
+
+    float_data = {'people': float_people, 'projects': float_projects, 'tasks': float_tasks}
+    sf_data = {'Contact': contacts, 'pse__Proj__c': sf_projects, 'pse__Milestone__c': milestones,
+               'pse__Project_Task__c': project_tasks, 'pse__Project_Task_Assignment__c': OrderedDict(),
+               'Attachment': attachments}
+    return float_data, sf_data
+
+
+def measure(func):
+    """
+        Runs func, returns (wall seconds, peak memory in MB, error message or None)
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    started = time.time()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        elapsed = time.time() - started
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            # ru_maxrss is the peak of the whole process, in KB on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return elapsed, peak / (1024.0 * 1024.0), error
+
+
+def compare(results, baseline, tolerance):
+    """
+        Returns the regressions of results against a saved baseline
+    """
+    regressions = []
+    for command, result in results.items():
+        before = baseline.get(command)
+        if before is None:
+            continue
+        if result['error'] and not before.get('error'):
+            regressions.append('{}: {}'.format(command, result['error']))
+        for metric in ['wall', 'peak_mb', 'total_calls']:
+            if before[metric] and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append('{}: {} {:.2f} -> {:.2f}'.format(command, metric, before[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--tasks', type=int, default=10, help='tasks per project')
+    parser.add_argument('--people', type=int, default=50)
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024, help='bytes per project plan')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--float-latency', type=float, default=50, help='ms per request')
+    parser.add_argument('--sf-latency', type=float, default=100, help='ms per request')
+    parser.add_argument('--slack-latency', type=float, default=30, help='ms per request')
+    parser.add_argument('--float-rate', type=float, default=0, help='requests per second, 0 is unlimited')
+    parser.add_argument('--sf-rate', type=float, default=0, help='requests per second, 0 is unlimited')
+    parser.add_argument('--slack-rate', type=float, default=1, help='messages per second and channel')
+    parser.add_argument('--float-page-size', type=int, default=200, help='max records per Float page')
+    parser.add_argument('--sf-batch-size', type=int, default=2000, help='records per SOQL result page')
+    parser.add_argument('--sf-daily-limit', type=int, default=1000000, help='daily API requests of the fake org')
+    parser.add_argument('--command', action='append', dest='commands',
+                        help='bot command to run, {session} is replaced; default: ' + ', '.join(DEFAULT_COMMANDS))
+    parser.add_argument('--save', help='write the results as json')
+    parser.add_argument('--compare', help='json of a previous --save, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed growth before a regression')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='slackbot-bench-')
+    os.environ['SALESFORCE_URL'] = SALESFORCE_HOST
+    os.environ['FLOAT_API_KEY'] = 'bench'
+    os.environ['SLACK_BOT_TOKEN'] = 'xoxb-bench'
+    os.environ['SNAPSHOT_DB'] = os.path.join(workdir, 'snapshot.db')
+
+    float_data, sf_data = generate_data(args.projects, args.tasks, args.people, args.attachment_size, args.seed)
+    backends = OrderedDict([
+        (FLOAT_HOST, FakeFloat(float_data, args.float_page_size, latency=args.float_latency, rate=args.float_rate)),
+        (SALESFORCE_HOST, FakeSalesforce(sf_data, args.sf_batch_size, args.sf_daily_limit,
+                                         latency=args.sf_latency, rate=args.sf_rate)),
+        (SLACK_HOST, FakeSlack(latency=args.slack_latency, rate=args.slack_rate)),
+    ])
+    router = Router()
+    for host, backend in backends.items():
+        router.serve(host, backend)
+    router.install()
+
+    cwd = os.getcwd()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # reports, attachments and caches of the bot go to the temp dir
+    os.chdir(workdir)
+    results = OrderedDict()
+    try:
+        import slackbot
+        bot = slackbot.ScheduleBot()
+        print('{} projects x {} tasks, {} people'.format(args.projects, args.tasks, args.people))
+        for command in args.commands or DEFAULT_COMMANDS:
+            command = command.format(session=SESSION_ID)
+            for backend in backends.values():
+                backend.reset()
+            wall, peak, error = measure(lambda: bot.handle_command(command, CHANNEL))
+            calls = OrderedDict()
+            for backend in backends.values():
+                for endpoint, count in sorted(backend.reset().items()):
+                    calls['{} {}'.format(backend.name, endpoint)] = count
+            name = command.replace(SESSION_ID, '<session>')
+            results[name] = {'wall': wall, 'peak_mb': peak, 'total_calls': sum(calls.values()), 'calls': calls,
+                             'error': error}
+
+            print('\n{}: {:.2f}s, peak {:.1f} MB, {} calls{}'.format(
+                name, wall, peak, sum(calls.values()), ', failed: {}'.format(error) if error else ''))
+            for endpoint, count in calls.items():
+                print('    {:>6}  {}'.format(count, endpoint))
+    finally:
+        os.chdir(cwd)
+        router.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as result_file:
+            json.dump(results, result_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
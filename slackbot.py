@@ -1,4 +1,5 @@
 import os
+import sys
 import requests
 from datetime import datetime
 import time
@@ -6,14 +7,41 @@ import re
 import csv
 import pytz
 import dateutil.parser
-from simple_salesforce import Salesforce, SFType
+import dateutil.relativedelta
+from simple_salesforce import Salesforce, SalesforceExpiredSession
 from slackclient import SlackClient
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 from datetime import datetime, date, timedelta
 import logging
 logging.basicConfig()
 import pdb
 import uuid
+import string
+import json
+import hmac
+import hashlib
+import sqlite3
+import random
+import threading
+import socket
+from collections import deque, OrderedDict
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+try:
+    from urllib import quote
+    from urlparse import urlsplit, parse_qs
+except ImportError:
+    from urllib.parse import quote, urlsplit, parse_qs
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
 
 eastern = pytz.timezone('US/Eastern')
 
@@ -28,10 +56,77 @@ else:
     SALESFORCE_URL = "SALESFORCE DOMAIN"
 
 DOWNLOAD_LINK = "https://greenwayhealth--c.na45.content.force.com/servlet/servlet.FileDownload?file="
-RTM_READ_DELAY = 1 # 1 second delay between reading from RTM
+RTM_READ_DELAY = 1 # max delay between reading from RTM while nothing is happening
+RTM_MIN_DELAY = 0.05 # first back off step once RTM goes quiet, doubled up to RTM_READ_DELAY
 EXAMPLE_COMMAND = "sync"
-EXAMPLE_COMMANDs = ["sync", "report", "projectplan"]
-MENTION_REGEX = "^<@(|[WU].+?)>(.*)"
+# command name -> inline: cheap commands answered from the RTM loop instead of the job queue
+# inline commands are answered right away, the others run on the job queue; usage is the help text
+COMMANDS = OrderedDict([
+    ("sync", {"inline": False, "usage": "sync <session id> [full] [shards <n>] | sync resume <run> <session id>"}),
+    ("report", {"inline": False, "usage": "report"}),
+    ("projectplan", {"inline": False, "usage": "projectplan <session id> <modified since YYYY-MM-DD>"}),
+    ("contacts", {"inline": True, "usage": "contacts"}),
+    ("jobs", {"inline": True, "usage": "jobs"}),
+    ("status", {"inline": True, "usage": "status"}),
+    ("stats", {"inline": True, "usage": "stats"}),
+])
+JOB_WORKERS = 4 # commands running at the same time
+JOB_CHANNEL_LIMIT = 1 # commands of one channel running at the same time
+MENTION_REGEX = re.compile("^<@(|[WU].+?)>(.*)")
+EVENTS_PORT = int(os.environ.get("EVENTS_PORT", 3000)) # port of the Events API receiver
+EVENT_MAX_AGE = 5 * 60 # seconds, older signed requests are rejected as replays
+EVENT_DEDUPE_SIZE = 10000 # event_ids remembered to drop Slack's retries
+EVENT_DEDUPE_TTL = 60 * 60 # seconds an event_id stays in the local cache and the snapshot db
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9102)) # local /metrics endpoint in RTM mode, 0 turns it off
+TRACE_HISTORY = 10 # span trees of the last commands kept for `stats`
+TRACE_TOP_SPOTS = 5 # endpoints and projects listed by `stats`
+FLOAT_PER_PAGE = 200
+FLOAT_PAGE_WORKERS = 4 # max number of Float pages fetched at the same time
+FLOAT_POOL_SIZE = 10 # keep-alive connections kept open to Float
+FLOAT_MAX_CONCURRENCY = 8 # Float requests in flight at the same time, across all threads
+FLOAT_RATE_LIMIT = float(os.environ.get("FLOAT_RATE_LIMIT", 3)) # Float requests per second of this process
+FLOAT_RATE_RESERVE = int(os.environ.get("FLOAT_RATE_RESERVE", 10)) # calls of Float's per minute quota left to others
+SF_RATE_LIMIT = float(os.environ.get("SF_RATE_LIMIT", 20)) # Salesforce requests per second of this process
+SF_MAX_CONCURRENCY = 10 # Salesforce requests in flight at the same time
+SF_API_RESERVE = float(os.environ.get("SF_API_RESERVE", 0.1)) # share of the daily API quota left to others
+SF_BUDGET_RECHECK = 5 * 60 # seconds before one call re-reads an exhausted daily quota
+FLOAT_TIMEOUT = (5, 30) # connect / read timeout in seconds
+FLOAT_MAX_RETRIES = 5 # retries on 429, 5xx and connection errors
+FLOAT_BACKOFF_BASE = 0.5 # seconds, doubled on every retry
+PEOPLE_DIRECTORY_TTL = 15 * 60 # seconds before the cached Float people list is reloaded
+CONTACT_CACHE_SIZE = 2000 # contacts kept in the resolver cache
+CONTACT_CACHE_TTL = 60 * 60 # seconds a cached contact stays valid
+SNAPSHOT_DB = os.environ.get("SNAPSHOT_DB", "snapshot.db") # local state of the last sync
+SNAPSHOT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+SNAPSHOT_OVERLAP = timedelta(minutes=5) # re-read tasks modified shortly before the last checkpoint
+SQLITE_IN_CHUNK_SIZE = 500 # stays below sqlite's host parameter limit
+SQLITE_TIMEOUT = 30 # seconds to wait for the lock of another process on the snapshot db
+SHARD_LEASE = 120 # seconds a claimed shard stays with its worker without a heartbeat
+SHARD_MAX_ATTEMPTS = 3 # claims of a shard before it is given up
+SHARD_POLL_INTERVAL = 2 # seconds between two looks for claimable shards
+SF_SESSION_TTL = 10 * 60 # seconds a validated Salesforce session is trusted without asking again
+SF_SESSION_CACHE_SIZE = 100
+DESCRIBE_CACHE_DIR = './.describe_cache' # Salesforce describe results
+DESCRIBE_CACHE_TTL = 24 * 60 * 60
+SLACK_POST_INTERVAL = 1.1 # seconds between two posts in a channel, Slack allows about one per second
+SLACK_DIGEST_INTERVAL = 10 # seconds status lines are buffered before a digest is posted
+SLACK_DIGEST_MAX_CHARS = 3500 # longer digests are split in several messages
+SLACK_MAX_RETRIES = 3 # retries of a post answered with ratelimited
+LOGS_DIR = './logs' # full per task logs of the commands
+REPORTS_DIR = './reports' # generated csv files
+EXCELS_DIR = './excels' # downloaded project plan attachments
+ATTACHMENT_WORKERS = 6 # attachments downloaded at the same time
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_PROGRESS_INTERVAL = 5 # seconds between two progress updates in Slack
+REPORT_CATEGORIES_FILE = os.environ.get("REPORT_CATEGORIES", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "report_categories.json"))
+SOQL_IN_CHUNK_SIZE = 200 # values per IN (...) clause, keeps queries under the SOQL length limit
+SF_COLLECTION_SIZE = 200 # max records per sObject Collections request
+SYNC_PROJECT_WORKERS = int(os.environ.get("SYNC_PROJECT_WORKERS", 6)) # projects fetched at the same time by sync
+SYNC_FETCH_AHEAD = 2 * SYNC_PROJECT_WORKERS # fetched projects waiting to be matched, bounds memory
+SF_TASK_FIELDS = ['Id', 'Name', 'pse__Project__c', 'pse__Milestone__c', 'pse__Assigned_Resources__c',
+                  'pse__Assigned_Resources_Long__c', 'pse__Start_Date_Time__c', 'pse__End_Date_Time__c']
+SF_DATETIME_FIELDS = ['pse__Start_Date_Time__c', 'pse__End_Date_Time__c']
 
 def get_start_end_dates(year, week):
     d = date(year,1,1)
@@ -45,16 +140,548 @@ def get_start_end_dates(year, week):
         "end_datetime": d + dlt + timedelta(days=6)
     }
 
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def soql_literal(value):
+    """
+        SOQL literal of a python value, strings are quoted and escaped
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return "({})".format(", ".join(soql_literal(item) for item in value))
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+class SoqlFormatter(string.Formatter):
+    """
+        {} placeholders become escaped literals, {:literal} inserts the value as is
+    """
+    def format_field(self, value, format_spec):
+        if format_spec == 'literal':
+            return format(value)
+        return soql_literal(value)
+
+def format_soql(query, *args, **kwargs):
+    return SoqlFormatter().format(query, *args, **kwargs)
+
+def iter_query(sf, query):
+    """
+        Yields the records of a SOQL query lazily across nextRecordsUrl pages.
+        The next page is fetched in the background while the current one is consumed,
+        so at most two pages are held in memory.
+    """
+    result = sf.query(query)
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            next_page = None
+            if not result.get('done', True) and result.get('nextRecordsUrl'):
+                next_page = executor.submit(TRACER.within, TRACER.current(),
+                                            sf.query_more, result['nextRecordsUrl'], True)
+            for record in result['records']:
+                yield record
+            if next_page is None:
+                return
+            result = next_page.result()
+    finally:
+        executor.shutdown(wait=False)
+
+def shard_of(project_id, shard_count):
+    # stable across processes and machines, unlike hash()
+    return int(hashlib.md5(str(project_id).encode('utf-8')).hexdigest(), 16) % shard_count
+
+def worker_name():
+    """
+        Unique owner of one shard claim: host, process and a random part
+    """
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+def replace_file(source, destination):
+    # atomic on POSIX; os.replace also overwrites on Windows but only exists on Python 3
+    getattr(os, 'replace', os.rename)(source, destination)
+
+def write_errors(result):
+    return ', '.join(error.get('message', '') for error in result.get('errors', []))
+
+def get_week_starts(start_date, end_date):
+    """
+        Mondays of the weeks from the week of start_date up to, not including, the week of end_date
+    """
+    week_start = start_date - timedelta(days=start_date.weekday())
+    last_week_start = end_date - timedelta(days=end_date.weekday())
+    weeks = []
+    while week_start < last_week_start:
+        weeks.append(week_start)
+        week_start = week_start + timedelta(days=7)
+    return weeks
+
+def bucket_tasks_by_week(tasks, weeks):
+    """
+        Returns {week start: [tasks]}, a task spanning several weeks is in each of them
+    """
+    buckets = OrderedDict((week_start, []) for week_start in weeks)
+    if len(weeks) == 0:
+        return buckets
+
+    range_start = min(weeks)
+    range_end = max(weeks) + timedelta(days=6)
+    for task in tasks:
+        task_start = max(datetime.strptime(task["start_date"], '%Y-%m-%d').date(), range_start)
+        task_end = min(datetime.strptime(task["end_date"], '%Y-%m-%d').date(), range_end)
+        week_start = task_start - timedelta(days=task_start.weekday())
+        while week_start <= task_end:
+            if week_start in buckets:
+                buckets[week_start].append(task)
+            week_start = week_start + timedelta(days=7)
+    return buckets
+
+def salesforce_endpoint(method, url):
+    """
+        Metric name of a Salesforce REST call: queries by sObject, record ids left out
+    """
+    parts = urlsplit(url)
+    path = re.sub(r'^/services/data/v[\d.]+', '', parts.path).rstrip('/')
+    if path == '/query':
+        m = re.search(r'\bfrom\s+(\w+)', ' '.join(parse_qs(parts.query).get('q', [])), re.IGNORECASE)
+        return '{} query {}'.format(method, m.group(1) if m else '')
+    if path.startswith('/query/'):
+        return '{} query more'.format(method)
+    return '{} {}'.format(method, re.sub(r'/[a-zA-Z0-9]{15,18}(?=/|$)', '/<id>', path))
+
+def trace_salesforce_response(resp, *args, **kwargs):
+    # requests response hook, elapsed is the time until the response headers arrived
+    TRACER.add_call('salesforce', salesforce_endpoint(resp.request.method, resp.url),
+                    resp.elapsed.total_seconds(), str(resp.status_code) if resp.status_code >= 400 else None)
+    return resp
+
+def metrics_response():
+    return TRACER.render_metrics() + GOVERNOR.render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+class Span:
+    """
+        one timed step of a command: the command itself, a project or an outbound call
+    """
+    def __init__(self, name, kind, backend=None):
+        self.name = name
+        self.kind = kind
+        self.backend = backend
+        self.children = []
+        self.started = time.time()
+        self.duration = None
+        self.error = None
+
+    def walk(self):
+        yield self
+        for child in list(self.children):
+            for span in child.walk():
+                yield span
+
+
+class Tracer:
+    """
+        records spans (command -> project -> call) of the running commands and Prometheus style
+        metrics of every outbound call. Helper threads continue the span of the command that
+        started them with activate(). The span trees of the last commands are kept for `stats`.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, history=TRACE_HISTORY):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.traces = deque(maxlen=history)
+        self.calls = {} # (backend, endpoint) -> histogram
+        self.retries = {} # (backend, endpoint) -> retried calls
+        self.commands = {} # command -> histogram
+
+    def current(self):
+        return getattr(self.local, 'span', None)
+
+    def activate(self, span):
+        self.local.span = span
+
+    def within(self, span, func, *args):
+        """
+            Runs func on a helper thread as part of span
+        """
+        self.activate(span)
+        return func(*args)
+
+    @contextmanager
+    def span(self, name, kind='span', backend=None, keep=True):
+        """
+            Times the with block as a child of the current span. Command spans are kept
+            in the history when keep is set, call spans go into the metrics
+        """
+        parent = self.current()
+        span = Span(name, kind, backend)
+        if parent is not None:
+            with self.lock:
+                parent.children.append(span)
+        self.local.span = span
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            span.duration = time.time() - span.started
+            self.local.span = parent
+            if kind == 'call':
+                self.observe(self.calls, (backend, name), span.duration, span.error)
+            elif kind == 'command':
+                self.observe(self.commands, name, span.duration, span.error)
+                if keep:
+                    with self.lock:
+                        self.traces.append(span)
+
+    def call(self, backend, endpoint):
+        return self.span(endpoint, 'call', backend)
+
+    def add_call(self, backend, endpoint, duration, error=None):
+        """
+            Records a call that was timed by someone else
+        """
+        span = Span(endpoint, 'call', backend)
+        span.started = time.time() - duration
+        span.duration = duration
+        span.error = error
+        parent = self.current()
+        if parent is not None:
+            with self.lock:
+                parent.children.append(span)
+        self.observe(self.calls, (backend, endpoint), duration, error)
+
+    def add_retry(self, backend, endpoint):
+        with self.lock:
+            self.retries[(backend, endpoint)] = self.retries.get((backend, endpoint), 0) + 1
+
+    def observe(self, histograms, key, duration, error):
+        with self.lock:
+            histogram = histograms.setdefault(key, {
+                "buckets": [0] * len(self.BUCKETS), "count": 0, "sum": 0.0, "errors": 0})
+            for i, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    histogram["buckets"][i] = histogram["buckets"][i] + 1
+                    break
+            histogram["count"] = histogram["count"] + 1
+            histogram["sum"] = histogram["sum"] + duration
+            if error:
+                histogram["errors"] = histogram["errors"] + 1
+
+    def render_metrics(self):
+        """
+            Prometheus text exposition of the call and command metrics
+        """
+        lines = []
+        with self.lock:
+            for metric, help_text, histograms in [
+                    ('slackbot_api_call', 'outbound API calls', [
+                        (dict(backend=backend, endpoint=endpoint), self.calls[(backend, endpoint)])
+                        for backend, endpoint in sorted(self.calls.keys())]),
+                    ('slackbot_command', 'bot commands', [
+                        (dict(command=command), self.commands[command]) for command in sorted(self.commands.keys())])]:
+                lines.append('# HELP {}_seconds Latency of {}'.format(metric, help_text))
+                lines.append('# TYPE {}_seconds histogram'.format(metric))
+                for labels, histogram in histograms:
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                        cumulative = cumulative + count
+                        lines.append('{}_seconds_bucket{{{},le="{}"}} {}'.format(
+                            metric, self.labels(labels), bound, cumulative))
+                    lines.append('{}_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                        metric, self.labels(labels), histogram["count"]))
+                    lines.append('{}_seconds_sum{{{}}} {:.6f}'.format(metric, self.labels(labels), histogram["sum"]))
+                    lines.append('{}_seconds_count{{{}}} {}'.format(metric, self.labels(labels), histogram["count"]))
+                lines.append('# HELP {}_errors_total Failed {}'.format(metric, help_text))
+                lines.append('# TYPE {}_errors_total counter'.format(metric))
+                for labels, histogram in histograms:
+                    lines.append('{}_errors_total{{{}}} {}'.format(metric, self.labels(labels), histogram["errors"]))
+            lines.append('# HELP slackbot_api_retries_total Retried outbound API calls')
+            lines.append('# TYPE slackbot_api_retries_total counter')
+            for backend, endpoint in sorted(self.retries.keys()):
+                lines.append('slackbot_api_retries_total{{{}}} {}'.format(
+                    self.labels(dict(backend=backend, endpoint=endpoint)), self.retries[(backend, endpoint)]))
+        return '\n'.join(lines) + '\n'
+
+    def labels(self, labels):
+        return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, value in sorted(labels.items()))
+
+    def summary(self, top=TRACE_TOP_SPOTS):
+        """
+            Hot spots of the last kept command as text, None before the first one finished
+        """
+        with self.lock:
+            trace = self.traces[-1] if self.traces else None
+        if trace is None:
+            return None
+
+        backends = OrderedDict()
+        endpoints = {}
+        projects = []
+        for span in trace.walk():
+            if span.kind == 'call':
+                backend = backends.setdefault(span.backend, {"count": 0, "time": 0.0, "errors": 0})
+                endpoint = endpoints.setdefault((span.backend, span.name), {"count": 0, "time": 0.0, "errors": 0})
+                for stat in (backend, endpoint):
+                    stat["count"] = stat["count"] + 1
+                    stat["time"] = stat["time"] + span.duration
+                    stat["errors"] = stat["errors"] + (1 if span.error else 0)
+            elif span.kind == 'project' and span.duration is not None:
+                projects.append(span)
+
+        lines = ['Last {}: {:.1f}s{}, finished {:.0f}s ago'.format(
+            trace.name, trace.duration, ' (failed: {})'.format(trace.error) if trace.error else '',
+            time.time() - trace.started - trace.duration)]
+        lines.append('Time waiting on calls, summed over threads: ' + ', '.join(
+            '{} {:.1f}s ({} calls, {} errors)'.format(name, stat["time"], stat["count"], stat["errors"])
+            for name, stat in backends.items()))
+        lines.append('Hot spots:')
+        for (backend, endpoint), stat in sorted(endpoints.items(), key=lambda item: -item[1]["time"])[:top]:
+            lines.append('  {} {}: {} calls, {:.1f}s, avg {:.3f}s, {:.0%} errors'.format(
+                backend, endpoint, stat["count"], stat["time"], stat["time"] / stat["count"],
+                float(stat["errors"]) / stat["count"]))
+        if projects:
+            lines.append('Slowest projects: ' + ', '.join(
+                '{} {:.1f}s'.format(span.name, span.duration)
+                for span in sorted(projects, key=lambda span: -span.duration)[:top]))
+        return '\n'.join(lines)
+
+
+TRACER = Tracer()
+
+
+class TracedSlackClient(SlackClient):
+    """
+        SlackClient whose Web API calls are traced
+    """
+    def api_call(self, method, timeout=None, **kwargs):
+        with TRACER.call('slack', method) as span:
+            result = SlackClient.api_call(self, method, timeout=timeout, **kwargs)
+            if isinstance(result, dict) and not result.get('ok', True):
+                span.error = result.get('error')
+            return result
+
+class FloatAPIError(Exception):
+    """
+        raised when a Float call still fails after all retries
+    """
+    pass
+
+class ApiBudgetExceeded(Exception):
+    """
+        raised instead of a call that would eat into the API budget kept for other integrations
+    """
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+class ApiBudget:
+    """
+        client side budget of one backend: a token bucket of rate calls per second, an AIMD limit
+        on the calls in flight (+1 per limit successful calls, halved on a rate limit answer)
+        and the remaining quota its response headers report. acquire() waits for a token and a
+        slot and pauses while the backend asked to back off. Once the remaining quota is down to
+        the reserve it pauses until a quota of window seconds refills, or raises ApiBudgetExceeded
+        for a daily quota (window None). Every recheck seconds one call of an exhausted daily quota
+        goes through anyway, its answer tells whether the quota is back.
+    """
+    def __init__(self, name, rate, max_concurrency, reserve, parse_headers, window=None, recheck=None):
+        self.name = name
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.time()
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.reserve = reserve
+        self.parse_headers = parse_headers
+        self.window = window
+        self.recheck = recheck
+        self.remaining = None
+        self.total = None
+        self.reported_at = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    def reserved(self):
+        # reserve is a share of the quota when it is below 1, otherwise a number of calls
+        if self.total is None:
+            return 0
+        return self.total * self.reserve if self.reserve < 1 else self.reserve
+
+    def acquire(self):
+        with self.cond:
+            probe = False
+            while True:
+                now = time.time()
+                if self.remaining is not None and self.remaining <= self.reserved() and not probe:
+                    if self.window is not None:
+                        # wait until enough of the window's quota came back, the next answer tells the rest
+                        self.paused_until = max(self.paused_until, now + self.window * float(
+                            self.reserved() - self.remaining + 1) / max(self.total, 1))
+                        self.remaining = None
+                    elif self.recheck is not None and now - self.reported_at >= self.recheck:
+                        # the others keep failing until this call's answer updates the quota
+                        self.reported_at = now
+                        probe = True
+                    else:
+                        raise ApiBudgetExceeded('{} API budget is down to {} of {} calls, {:.0f} are kept for '
+                                                'other integrations'.format(self.name, self.remaining, self.total,
+                                                                            self.reserved()))
+                self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0)
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.tokens = self.tokens - 1
+                    self.in_flight = self.in_flight + 1
+                    return
+                # release() wakes us up early when a slot frees
+                self.cond.wait(wait if wait > 0 else None)
+
+    def release(self, status=None, headers=None):
+        with self.cond:
+            self.in_flight = self.in_flight - 1
+            remaining, total, retry_after, limited = self.parse_headers(status, headers or {})
+            if remaining is not None:
+                self.remaining = remaining
+                self.total = total
+                self.reported_at = time.time()
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+            if limited:
+                self.throttled = self.throttled + 1
+                # one decrease per round trip, not one per call that was already in flight
+                if time.time() - self.last_decrease > 1:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = time.time()
+            elif status is not None and status < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def describe(self):
+        with self.cond:
+            if self.remaining is None:
+                quota = 'quota not reported yet'
+            else:
+                quota = '{} of {} calls left (stops at {:.0f})'.format(self.remaining, self.total, self.reserved())
+            return '{}: {}, {} of {} parallel calls{}'.format(
+                self.name, quota, int(self.limit), self.max_concurrency,
+                ', throttled {} times'.format(self.throttled) if self.throttled else '')
+
+
+def float_limit_headers(status, headers):
+    """
+        (remaining, total, retry after seconds, rate limited) of a Float response
+    """
+    remaining = headers.get('X-RateLimit-Remaining')
+    total = headers.get('X-RateLimit-Limit')
+    retry_after = headers.get('Retry-After')
+    try:
+        remaining = int(remaining) if remaining is not None and total is not None else None
+        total = int(total) if remaining is not None else None
+        retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+        remaining = total = retry_after = None
+    return remaining, total, retry_after, status == 429
+
+def salesforce_limit_headers(status, headers):
+    """
+        (remaining, total, retry after seconds, rate limited) from Sforce-Limit-Info: api-usage=used/max
+    """
+    remaining = total = None
+    m = re.search(r'api-usage=(\d+)/(\d+)', headers.get('Sforce-Limit-Info', ''))
+    if m is not None:
+        total = int(m.group(2))
+        remaining = total - int(m.group(1))
+    # REQUEST_LIMIT_EXCEEDED comes as a 403 once the org's quota is used up
+    limited = status == 503 or (status == 403 and remaining is not None and remaining <= 0)
+    return remaining, total, None, limited
+
+
+class ApiGovernor:
+    """
+        the API budgets of the process, shared by every command and thread
+    """
+    def __init__(self):
+        self.budgets = OrderedDict([
+            ('salesforce', ApiBudget('Salesforce', SF_RATE_LIMIT, SF_MAX_CONCURRENCY, SF_API_RESERVE,
+                                     salesforce_limit_headers, recheck=SF_BUDGET_RECHECK)),
+            # Float's quota is per minute, so running low pauses the calls instead of stopping the run
+            ('float', ApiBudget('Float', FLOAT_RATE_LIMIT, FLOAT_MAX_CONCURRENCY, FLOAT_RATE_RESERVE,
+                                float_limit_headers, window=60)),
+        ])
+
+    def __getitem__(self, name):
+        return self.budgets[name]
+
+    def describe(self):
+        return '; '.join(budget.describe() for budget in self.budgets.values())
+
+    def render_metrics(self):
+        lines = ['# HELP slackbot_api_budget_remaining Calls left in the quota reported by the backend',
+                 '# TYPE slackbot_api_budget_remaining gauge']
+        for name, budget in self.budgets.items():
+            if budget.remaining is not None:
+                lines.append('slackbot_api_budget_remaining{{backend="{}"}} {}'.format(name, budget.remaining))
+        lines.append('# HELP slackbot_api_concurrency_limit Calls allowed in flight by the AIMD limit')
+        lines.append('# TYPE slackbot_api_concurrency_limit gauge')
+        for name, budget in self.budgets.items():
+            lines.append('slackbot_api_concurrency_limit{{backend="{}"}} {}'.format(name, int(budget.limit)))
+        return '\n'.join(lines) + '\n'
+
+
+GOVERNOR = ApiGovernor()
+
+
+class GovernedSession(requests.Session):
+    """
+        requests session of a Salesforce instance, every call waits for the Salesforce budget
+    """
+    def __init__(self, budget):
+        super(GovernedSession, self).__init__()
+        self.budget = budget
+
+    def request(self, method, url, *args, **kwargs):
+        self.budget.acquire()
+        resp = None
+        try:
+            resp = super(GovernedSession, self).request(method, url, *args, **kwargs)
+            return resp
+        finally:
+            self.budget.release(resp.status_code if resp is not None else None,
+                                resp.headers if resp is not None else None)
+
+
 class FloatAPI:
     """
         api wrapper for FLOAT.COM
     """
-    def __init__(self):
+    def __init__(self, pool_size=FLOAT_POOL_SIZE, timeout=FLOAT_TIMEOUT, max_retries=FLOAT_MAX_RETRIES):
         self.url = "https://api.float.com/v3"
         self.access_key = FLOAT_API_KEY             # access key to float.com
         self.projects = []
         self.tasks = []
         self.people = []
+        self.project_names = {}
+        self.project_names_loaded = False
+        # people directory indexed by people_id, reloaded after PEOPLE_DIRECTORY_TTL
+        self.people_by_id = {}
+        self.people_loaded_at = None
+        self.people_lookups_saved = 0
         self.base_headers = {
             "Authorization":"Bearer {}".format(self.access_key),
             "User-Agent":"MedmetryPyFloat",
@@ -62,58 +689,218 @@ class FloatAPI:
             "Accept":"application/json"
         }
 
+        # one keep-alive session shared by every call (and every page worker)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update(self.base_headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # rate, concurrency and quota are shared with every other FloatAPI of the process
+        self.budget = GOVERNOR['float']
+
+    def endpoint_name(self, path):
+        # /people/17145442 and /people/17145443 are the same endpoint
+        return re.sub(r'/\d+', '/<id>', path.split('?')[0])
+
+    def retry_delay(self, resp, attempt):
+        """
+            Honours Retry-After when Float sends it, otherwise jittered exponential backoff
+        """
+        if resp is not None and resp.headers.get("Retry-After"):
+            try:
+                return float(resp.headers["Retry-After"])
+            except ValueError:
+                pass
+        return random.uniform(0, FLOAT_BACKOFF_BASE * (2 ** attempt))
+
+    def request(self, path, params=None):
+        """
+            GET a Float endpoint, retrying 429/5xx and connection errors.
+            Returns the response, None for 404, and raises FloatAPIError otherwise.
+        """
+        url = self.url + path
+        if params:
+            url = url + ("&" if "?" in url else "?") + params
+
+        # latency and errors go into the call metrics, retries into their own counter
+        endpoint = "GET " + self.endpoint_name(path)
+        with TRACER.call("float", endpoint):
+            attempt = 0
+            while True:
+                resp = None
+                error = None
+                self.budget.acquire()
+                try:
+                    resp = self.session.get(url, timeout=self.timeout)
+                except requests.exceptions.RequestException as e:
+                    error = e
+                finally:
+                    self.budget.release(resp.status_code if resp is not None else None,
+                                        resp.headers if resp is not None else None)
+
+                if resp is not None and resp.status_code < 400:
+                    return resp
+                if resp is not None and resp.status_code == 404:
+                    return None
+
+                retryable = resp is None or resp.status_code == 429 or resp.status_code >= 500
+                if not retryable or attempt >= self.max_retries:
+                    raise FloatAPIError("Float request {} failed: {}".format(
+                        self.endpoint_name(path), error if resp is None else resp.status_code))
+
+                TRACER.add_retry("float", endpoint)
+                time.sleep(self.retry_delay(resp, attempt))
+                attempt = attempt + 1
+
+    def get_page(self, path, params, page):
+        return self.request("{}?page={}&per-page={}".format(path, page, FLOAT_PER_PAGE), params)
+
+    def paginate(self, path, params=None):
+        """
+            Streams every record of a paginated list endpoint.
+            The first page is read right away (None is returned on 404) and tells us
+            X-Pagination-Page-Count; the remaining pages are fetched concurrently,
+            at most FLOAT_PAGE_WORKERS at a time, and yielded in page order.
+        """
+        first_page = self.get_page(path, params, 1)
+        if first_page is None:
+            return None
+
+        return self._iter_pages(path, params, first_page)
+
+    def _iter_pages(self, path, params, first_page):
+        for record in first_page.json():
+            yield record
+
+        page_count = int(first_page.headers.get("X-Pagination-Page-Count", 1))
+        if page_count <= 1:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=FLOAT_PAGE_WORKERS)
+        pending = deque()
+        next_page = 2
+        try:
+            while next_page <= page_count or pending:
+                # keep a bounded window of pages in flight so we never buffer the whole list
+                while next_page <= page_count and len(pending) < FLOAT_PAGE_WORKERS:
+                    pending.append(executor.submit(TRACER.within, TRACER.current(), self.get_page, path, params, next_page))
+                    next_page = next_page + 1
+
+                resp = pending.popleft().result()
+                if resp is None:
+                    continue
+                for record in resp.json():
+                    yield record
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
     def get_people(self):
-        resp = requests.get(self.url+"/people", headers=self.base_headers)
+        people = self.paginate("/people")
 
-        if resp.status_code == 200:
-            self.people = resp.json()
-            return resp.json()
+        if people is not None:
+            self.people = list(people)
+            return self.people
         else:
             return None
 
+    def load_people_directory(self, force=False):
+        """
+            Loads /people once and indexes it by people_id.
+            The directory is reused until PEOPLE_DIRECTORY_TTL expires.
+        """
+        if not force and self.people_loaded_at is not None and \
+                time.time() - self.people_loaded_at < PEOPLE_DIRECTORY_TTL:
+            return self.people_by_id
+
+        try:
+            people = self.get_people()
+        except FloatAPIError:
+            if self.people_loaded_at is None:
+                raise
+            # keep serving the previous directory if the reload failed
+            return self.people_by_id
+
+        self.people_by_id = dict((person["people_id"], person) for person in people or [])
+        self.people_loaded_at = time.time()
+        return self.people_by_id
+
+    def get_person(self, people_id):
+        """
+            Returns a person from the directory, falling back to a single
+            /people/<id> lookup only for ids the directory doesn't know.
+        """
+        directory = self.load_people_directory()
+        if people_id in directory:
+            self.people_lookups_saved = self.people_lookups_saved + 1
+            return directory[people_id]
+
+        person = self.get_person_by_id(people_id)
+        if person is not None:
+            directory[people_id] = person
+        return person
+
     def get_person_by_id(self, people_id=17145442):
-        resp = requests.get("{}/people/{}".format(self.url, people_id),
-                            headers=self.base_headers)
+        resp = self.request("/people/{}".format(people_id))
 
-        if resp.status_code < 400:
+        if resp is not None:
             return resp.json()
         else:
             return None
 
     def get_projects(self):
-        headers = self.base_headers
-        headers["X-Pagination-Current-Page"] = '2'
-        resp = requests.get(self.url+"/projects?per-page=200", headers=headers)
+        projects = self.paginate("/projects")
 
-        if resp.status_code == 200:
-            self.projects = resp.json()
+        if projects is not None:
+            self.projects = list(projects)
             return self.projects
         else:
             return None
 
+    def iter_projects(self):
+        """
+            Same as get_projects but yields projects while the next pages are downloaded
+        """
+        return self.paginate("/projects") or iter([])
+
+    def get_project_name(self, project_id):
+        """
+            Project name by id, the names of all projects come from one paginated pass
+        """
+        if project_id not in self.project_names and not self.project_names_loaded:
+            for project in self.iter_projects():
+                self.project_names[project["project_id"]] = project["name"]
+            self.project_names_loaded = True
+        if project_id not in self.project_names:
+            # not in the list, e.g. created since it was loaded
+            project = self.get_project_by_id(project_id)
+            self.project_names[project_id] = project["name"] if project is not None else None
+        return self.project_names[project_id]
+
     def get_project_by_id(self, project_id=17145442):
-        resp = requests.get("{}/projects/{}".format(self.url, project_id),
-                            headers=self.base_headers)
+        resp = self.request("/projects/{}".format(project_id))
 
-        if resp.status_code < 400:
+        if resp is not None:
             return resp.json()
         else:
             return None
 
     def get_tasks(self):
-        resp = requests.get(self.url+"/tasks", headers=self.base_headers)
+        tasks = self.paginate("/tasks")
 
-        if resp.status_code == 200:
-            self.tasks = resp.json()
+        if tasks is not None:
+            self.tasks = list(tasks)
             return self.tasks
         else:
             return None
 
     def get_task_by_id(self, task_id=17145442):
-        resp = requests.get("{}/tasks/{}".format(self.url, task_id),
-                            headers=self.base_headers)
+        resp = self.request("/tasks/{}".format(task_id))
 
-        if resp.status_code < 400:
+        if resp is not None:
             return resp.json()
         else:
             return None
@@ -123,10 +910,10 @@ class FloatAPI:
             Get tasks by parameters
             /tasks/?project_id=xxxxxx
         """
-        resp = requests.get("{}/tasks?{}".format(self.url, params),headers=self.base_headers)
+        tasks = self.paginate("/tasks", params)
 
-        if resp.status_code < 400:
-            return resp.json()
+        if tasks is not None:
+            return list(tasks)
         else:
             return []
 
@@ -141,52 +928,1033 @@ class FloatAPI:
         return float_tasks
 
 
-class ScheduleBot:
+class LRUCache:
+    """
+        thread safe LRU cache whose entries expire after ttl seconds
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[1] < time.time():
+                return default
+            # re-insert so the key becomes the most recently used
+            self.items[key] = item
+            return item[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time() + self.ttl)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            return item is not None and item[1] >= time.time()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ContactResolver:
+    """
+        resolves Salesforce contacts by name or id with batched IN (...) queries.
+        The cache lives as long as the bot process, so it is shared by every command.
+    """
+    FIELDS = "Id, Name, pse__Is_Resource__c, pse__Is_Resource_Active__c"
+    NOT_FOUND = object()
+
+    def __init__(self, get_sf, maxsize=CONTACT_CACHE_SIZE, ttl=CONTACT_CACHE_TTL):
+        # returns the Salesforce instance of the command being run
+        self.get_sf = get_sf
+        self.by_name = LRUCache(maxsize, ttl)
+        self.by_id = LRUCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        # project workers resolve contacts at the same time
+        self.stats_lock = threading.Lock()
+
+    def is_active_resource(self, record):
+        return record['pse__Is_Resource__c'] == True and record['pse__Is_Resource_Active__c']
+
+    def select_by_name(self, username, records):
+        """
+            Prefers the first active resource, otherwise the name is used as an external resource
+        """
+        if len(records) == 0:
+            return None
+
+        for record in records:
+            if self.is_active_resource(record):
+                return {'is_active': True, 'Id': record['Id'], 'Name': record['Name']}
+        return {'is_active': False, 'Id': username}
+
+    def select_by_id(self, record):
+        if record is not None and self.is_active_resource(record):
+            return record['Name']
+        return None
+
+    def query(self, where, values):
+        records = []
+        for chunk in chunks(sorted(values), SOQL_IN_CHUNK_SIZE):
+            self.count(queries=1)
+            records.extend(iter_query(self.get_sf(), format_soql(
+                "select {:literal} from Contact where {:literal} in {}", self.FIELDS, where, chunk)))
+        return records
+
+    def resolve_names(self, usernames):
+        """
+            Returns {username: contact info} and fetches every name that isn't cached in one pass
+        """
+        usernames = set(usernames)
+        missing = set(username for username in usernames if username not in self.by_name)
+        self.count(hits=len(usernames) - len(missing), misses=len(missing))
+        if missing:
+            # SOQL compares names case-insensitively
+            records_by_name = {}
+            for record in self.query("Name", missing):
+                records_by_name.setdefault(record['Name'].lower(), []).append(record)
+            for username in missing:
+                contact = self.select_by_name(username, records_by_name.get(username.lower(), []))
+                self.by_name.set(username, self.NOT_FOUND if contact is None else contact)
+
+        contacts = {}
+        for username in usernames:
+            contact = self.by_name.get(username, self.NOT_FOUND)
+            contacts[username] = None if contact is self.NOT_FOUND else contact
+        return contacts
+
+    def resolve_ids(self, ids):
+        """
+            Returns {contact id: name of the active resource or None}
+        """
+        ids = set(ids)
+        missing = set(contact_id for contact_id in ids if contact_id not in self.by_id)
+        self.count(hits=len(ids) - len(missing), misses=len(missing))
+        if missing:
+            records_by_id = dict((record['Id'], record) for record in self.query("Id", missing))
+            for contact_id in missing:
+                self.by_id.set(contact_id, self.select_by_id(records_by_id.get(contact_id)))
+
+        return dict((contact_id, self.by_id.get(contact_id)) for contact_id in ids)
+
+    def count(self, hits=0, misses=0, queries=0):
+        with self.stats_lock:
+            self.hits = self.hits + hits
+            self.misses = self.misses + misses
+            self.queries = self.queries + queries
+
+    def get_stats(self):
+        with self.stats_lock:
+            hits, misses, queries = self.hits, self.misses, self.queries
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / lookups if lookups else 0.0,
+            'cached': len(self.by_name) + len(self.by_id),
+            'queries': queries
+        }
+
+
+class SalesforceWriteQueue:
+    """
+        collects record updates and creates and sends them through the sObject Collections
+        API, SF_COLLECTION_SIZE records per request.
+        update() and create() return a handle to look the record's result up after flush()
+    """
+    def __init__(self, sf):
+        self.sf = sf
+        self.url = 'https://{base_url}/services/data/v47.0/composite/sobjects'.format(base_url=SALESFORCE_URL)
+        self.updates = OrderedDict()
+        self.creates = OrderedDict()
+
+    def update(self, sobject, record_id, fields):
+        # a record may only appear once per request, so updates of the same record are merged
+        handle = ('update', sobject, record_id)
+        self.updates.setdefault(handle, {}).update(fields)
+        return handle
+
+    def create(self, sobject, fields, key=None):
+        # creates sharing a key are merged into a single new record
+        handle = ('create', sobject, len(self.creates) if key is None else key)
+        self.creates.setdefault(handle, {}).update(fields)
+        return handle
+
+    def flush(self):
+        """
+            Sends every queued write and returns {handle: {'success': bool, 'errors': [...]}}
+        """
+        results = {}
+        self.send('PATCH', self.updates, results)
+        self.send('POST', self.creates, results)
+        self.updates = OrderedDict()
+        self.creates = OrderedDict()
+        return results
+
+    def send(self, method, writes, results):
+        # Salesforce splits a request into one chunk per run of the same sObject type and
+        # rejects more than 10 chunks, so the records of a type are sent next to each other
+        by_type = OrderedDict()
+        for handle in writes.keys():
+            by_type.setdefault(handle[1], []).append(handle)
+        handles = [handle for sobject_handles in by_type.values() for handle in sobject_handles]
+        for chunk in chunks(handles, SF_COLLECTION_SIZE):
+            records = []
+            for handle in chunk:
+                record = dict(writes[handle])
+                record['attributes'] = {'type': handle[1]}
+                if handle[0] == 'update':
+                    record['id'] = handle[2]
+                records.append(record)
+
+            resp = self.sf.session.request(method, self.url, headers=self.sf.headers,
+                                           data=json.dumps({'allOrNone': False, 'records': records}))
+            if resp.status_code >= 400:
+                # the whole request was rejected, so every record of the chunk failed
+                for handle in chunk:
+                    results[handle] = {'success': False, 'errors': [{'message': resp.text}]}
+                continue
+
+            for handle, result in zip(chunk, resp.json()):
+                results[handle] = result
+
+
+class SnapshotStore:
+    """
+        sqlite snapshot of the synced Float projects and of the Salesforce task / assignment ids
+        the Float tasks were written to, keyed by Float task_id. The checkpoint lets the next
+        sync pull only the Float tasks modified since then, the stored ids let it read only
+        their Salesforce tasks.
+    """
+    def __init__(self, path=SNAPSHOT_DB):
+        self.lock = threading.Lock()
+        # worker processes share the db, so wait for their locks instead of failing
+        self.conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                create table if not exists float_projects (
+                    project_id integer primary key, name text, data text
+                );
+                create table if not exists sf_tasks (
+                    task_id integer primary key, sf_task_id text, sf_assignment_id text, synced_at text
+                );
+                create table if not exists checkpoints (
+                    name text primary key, value text
+                );
+                create table if not exists attachments (
+                    doc_id text primary key, last_modified text, path text
+                );
+                create table if not exists report_weeks (
+                    week_start text, classifier_version text, data text,
+                    primary key (week_start, classifier_version)
+                );
+                create table if not exists sync_runs (
+                    run_id integer primary key autoincrement, channel text, checkpoint text,
+                    run_started text, status text, updated text
+                );
+                create table if not exists sync_run_projects (
+                    run_id integer, project_id integer, status text, error text, updated text,
+                    primary key (run_id, project_id)
+                );
+                create table if not exists sync_shards (
+                    run_id integer, shard integer, project_ids text, session_id text, channel text,
+                    status text, owner text, lease_until real, attempts integer, result text, error text,
+                    primary key (run_id, shard)
+                );
+                create table if not exists sync_run_records (
+                    run_id integer, project_id integer, task_id integer, sf_task_id text,
+                    outcome text, message text, created text
+                );
+                create table if not exists slack_events (
+                    event_id text primary key, received real
+                );
+            """)
+
+    def close(self):
+        self.conn.close()
+
+    def get_checkpoint(self, name):
+        with self.lock:
+            row = self.conn.execute("select value from checkpoints where name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_checkpoint(self, name, value):
+        with self.lock, self.conn:
+            self.conn.execute("insert or replace into checkpoints (name, value) values (?, ?)", (name, value))
+
+    def create_sync_run(self, channel, checkpoint, run_started):
+        """
+            checkpoint: the float_tasks checkpoint the run reads from, None for a full sync
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "insert into sync_runs (channel, checkpoint, run_started, status, updated) values (?, ?, ?, ?, ?)",
+                (channel, checkpoint, run_started, 'created', run_started))
+        return cursor.lastrowid
+
+    def get_sync_run(self, run_id):
+        with self.lock:
+            row = self.conn.execute(
+                "select run_id, channel, checkpoint, run_started, status from sync_runs where run_id = ?",
+                (run_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['run_id', 'channel', 'checkpoint', 'run_started', 'status'], row))
+
+    def set_sync_run_status(self, run_id, status):
+        with self.lock, self.conn:
+            self.conn.execute("update sync_runs set status = ?, updated = ? where run_id = ?",
+                              (status, datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT), run_id))
+
+    def get_sync_projects(self, run_id, status):
+        with self.lock:
+            rows = self.conn.execute(
+                "select project_id from sync_run_projects where run_id = ? and status = ?",
+                (run_id, status)).fetchall()
+        return set(row[0] for row in rows)
+
+    def set_sync_projects(self, run_id, project_ids, status, error=None):
+        updated = datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into sync_run_projects values (?, ?, ?, ?, ?)",
+                [(run_id, project_id, status, error, updated) for project_id in project_ids])
+
+    SHARD_FIELDS = ['run_id', 'shard', 'project_ids', 'session_id', 'channel', 'status',
+                    'owner', 'lease_until', 'attempts', 'result', 'error']
+
+    def shard_row(self, row):
+        shard = dict(zip(self.SHARD_FIELDS, row))
+        shard['project_ids'] = json.loads(shard['project_ids'])
+        shard['result'] = json.loads(shard['result']) if shard['result'] else None
+        return shard
+
+    def create_shards(self, run_id, shards, session_id, channel):
+        """
+            shards: list of project_id lists, queued for any worker to claim
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into sync_shards values (?, ?, ?, ?, ?, 'queued', null, 0, 0, null, null)",
+                [(run_id, shard, json.dumps(project_ids), session_id, channel)
+                 for shard, project_ids in enumerate(shards)])
+
+    def claim_shard(self, owner, run_id=None, lease=SHARD_LEASE):
+        """
+            Leases the next queued shard, or a running one whose lease ran out, to owner.
+            The single update keeps two workers from claiming the same shard.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "update sync_shards set status = 'running', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                "where rowid = (select rowid from sync_shards "
+                "where (status = 'queued' or (status = 'running' and lease_until < ?)) and attempts < ? "
+                "and (? is null or run_id = ?) order by run_id, shard limit 1)",
+                (owner, now + lease, now, SHARD_MAX_ATTEMPTS, run_id, run_id))
+            if cursor.rowcount == 0:
+                return None
+            row = self.conn.execute(
+                "select {} from sync_shards where owner = ? and status = 'running'".format(
+                    ", ".join(self.SHARD_FIELDS)), (owner,)).fetchone()
+        return self.shard_row(row) if row else None
+
+    def renew_shard(self, shard, owner, lease=SHARD_LEASE):
+        """
+            Heartbeat of the worker, False once the lease went to another worker
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "update sync_shards set lease_until = ? where run_id = ? and shard = ? and owner = ? "
+                "and status = 'running'", (time.time() + lease, shard['run_id'], shard['shard'], owner))
+        return cursor.rowcount > 0
+
+    def finish_shard(self, shard, owner, status, result=None, error=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "update sync_shards set status = ?, result = ?, error = ?, lease_until = null "
+                "where run_id = ? and shard = ? and owner = ?",
+                (status, json.dumps(result) if result is not None else None, error,
+                 shard['run_id'], shard['shard'], owner))
+
+    def expire_shards(self, run_id):
+        """
+            Gives up the shards whose last allowed worker stopped sending heartbeats
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "update sync_shards set status = 'failed', error = 'lease expired' where run_id = ? "
+                "and status = 'running' and lease_until < ? and attempts >= ?",
+                (run_id, time.time(), SHARD_MAX_ATTEMPTS))
+
+    def get_shards(self, run_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "select {} from sync_shards where run_id = ? order by shard".format(
+                    ", ".join(self.SHARD_FIELDS)), (run_id,)).fetchall()
+        return [self.shard_row(row) for row in rows]
+
+    def clear_shard_sessions(self, run_id):
+        # the Salesforce session id is only needed while the shards run
+        with self.lock, self.conn:
+            self.conn.execute("update sync_shards set session_id = null where run_id = ?", (run_id,))
+
+    def claim_event(self, event_id, ttl=EVENT_DEDUPE_TTL):
+        """
+            True for the first replica that receives event_id, False for Slack's retries
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("delete from slack_events where received < ?", (now - ttl,))
+            cursor = self.conn.execute("insert or ignore into slack_events values (?, ?)", (event_id, now))
+        return cursor.rowcount == 1
+
+    def save_sync_records(self, run_id, records):
+        """
+            records: (Float project_id, Float task_id, Salesforce task Id, outcome, message)
+        """
+        created = datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert into sync_run_records values (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,) + tuple(record) + (created,) for record in records])
+
+    def get_sync_records(self, run_id, project_ids):
+        """
+            Returns the latest (task_id, outcome, message) of every task of project_ids in the run
+        """
+        latest = OrderedDict()
+        with self.lock:
+            for chunk in chunks(sorted(set(project_ids)), SQLITE_IN_CHUNK_SIZE):
+                rows = self.conn.execute(
+                    "select task_id, outcome, message from sync_run_records where run_id = ? "
+                    "and project_id in ({}) order by rowid".format(", ".join("?" * len(chunk))),
+                    [run_id] + chunk).fetchall()
+                for row in rows:
+                    latest.pop(row[0], None)
+                    latest[row[0]] = tuple(row)
+        return list(latest.values())
+
+    def save_projects(self, projects):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into float_projects values (?, ?, ?)",
+                [(project["project_id"], project.get("name"), json.dumps(project)) for project in projects])
+
+    def get_projects(self, project_ids):
+        """
+            Returns the stored projects for project_ids; unknown ids are left out
+        """
+        projects = []
+        with self.lock:
+            for chunk in chunks(sorted(set(project_ids)), SQLITE_IN_CHUNK_SIZE):
+                rows = self.conn.execute(
+                    "select data from float_projects where project_id in ({})".format(
+                        ", ".join("?" * len(chunk))), chunk).fetchall()
+                projects.extend(json.loads(row[0]) for row in rows)
+        return projects
+
+    def save_sf_ids(self, records):
+        """
+            records: (float task_id, Salesforce task Id, Salesforce assignment Id)
+        """
+        synced_at = datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into sf_tasks values (?, ?, ?, ?)",
+                [(task_id, sf_task_id, sf_assignment_id, synced_at)
+                 for task_id, sf_task_id, sf_assignment_id in records])
+
+    def get_report_weeks(self, week_starts, classifier_version):
+        """
+            Returns {week start: cached aggregate} for the weeks computed with classifier_version
+        """
+        keys = [week_start.strftime("%Y-%m-%d") for week_start in week_starts]
+        weeks = {}
+        with self.lock:
+            for chunk in chunks(keys, SQLITE_IN_CHUNK_SIZE):
+                rows = self.conn.execute(
+                    "select week_start, data from report_weeks where classifier_version = ? "
+                    "and week_start in ({})".format(", ".join("?" * len(chunk))),
+                    [classifier_version] + chunk).fetchall()
+                for row in rows:
+                    weeks[datetime.strptime(row[0], "%Y-%m-%d").date()] = json.loads(row[1])
+        return weeks
+
+    def save_report_weeks(self, weeks, classifier_version):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into report_weeks values (?, ?, ?)",
+                [(week_start.strftime("%Y-%m-%d"), classifier_version, json.dumps(data))
+                 for week_start, data in weeks.items()])
+
+    def get_attachment(self, doc_id):
+        with self.lock:
+            row = self.conn.execute(
+                "select last_modified, path from attachments where doc_id = ?", (doc_id,)).fetchone()
+        return {'last_modified': row[0], 'path': row[1]} if row else None
+
+    def save_attachment(self, doc_id, last_modified, path):
+        with self.lock, self.conn:
+            self.conn.execute("insert or replace into attachments values (?, ?, ?)",
+                              (doc_id, last_modified, path))
+
+    def get_sf_ids(self, task_ids):
+        """
+            Returns {Float task_id: {'sf_task_id', 'sf_assignment_id'}} of the tasks synced before
+        """
+        sf_ids = {}
+        with self.lock:
+            for chunk in chunks(sorted(set(task_ids)), SQLITE_IN_CHUNK_SIZE):
+                rows = self.conn.execute(
+                    "select task_id, sf_task_id, sf_assignment_id from sf_tasks where task_id in ({})".format(
+                        ", ".join("?" * len(chunk))), chunk).fetchall()
+                for row in rows:
+                    sf_ids[row[0]] = {'sf_task_id': row[1], 'sf_assignment_id': row[2]}
+        return sf_ids
+
+
+class Job:
+    """
+        a bot command waiting for or running on the JobQueue
+    """
+    def __init__(self, job_id, command, channel):
+        self.id = job_id
+        self.command = command
+        self.channel = channel
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def name(self):
+        # never echo the arguments back, they contain the Salesforce session id
+        return self.command.split(" ")[0]
+
+    def elapsed(self):
+        return (self.finished or time.time()) - (self.started or self.created)
+
+
+class JobQueue:
+    """
+        runs bot commands on a bounded pool of worker threads.
+        At most per_channel jobs of the same channel run at once, the rest wait in order.
+        A job is 'waiting' behind its channel, 'queued' for a free worker, then 'running'.
+    """
+    def __init__(self, handler, workers=JOB_WORKERS, per_channel=JOB_CHANNEL_LIMIT):
+        self.handler = handler
+        self.per_channel = per_channel
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.waiting = {}       # channel -> deque of jobs over the channel limit
+        self.active = {}        # channel -> number of jobs handed to the executor
+        self.next_id = 1
+
+    def submit(self, command, channel):
+        with self.lock:
+            job = Job(self.next_id, command, channel)
+            self.next_id = self.next_id + 1
+            self.jobs[job.id] = job
+            if self.active.get(channel, 0) < self.per_channel:
+                self.start(job)
+            else:
+                job.status = 'waiting'
+                self.waiting.setdefault(channel, deque()).append(job)
+        return job
+
+    def start(self, job):
+        # called with self.lock held
+        job.status = 'queued'
+        self.active[job.channel] = self.active.get(job.channel, 0) + 1
+        self.executor.submit(self.run, job)
+
+    def run(self, job):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            self.handler(job.command, job.channel)
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = e
+            logging.exception("job #%s (%s) failed", job.id, job.name())
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                del self.jobs[job.id]
+                self.active[job.channel] = self.active[job.channel] - 1
+                waiting = self.waiting.get(job.channel)
+                if waiting:
+                    self.start(waiting.popleft())
+        return job
+
+    def list_jobs(self):
+        """
+            Returns the running and queued jobs in submission order
+        """
+        with self.lock:
+            return list(self.jobs.values())
+
+
+def slack_signature(signing_secret, timestamp, body):
+    """
+        v0 signature Slack sends in X-Slack-Signature, body is the raw request body
+    """
+    message = 'v0:{}:'.format(timestamp).encode('utf-8') + body
+    return 'v0=' + hmac.new(signing_secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+class EventsReceiver:
+    """
+        Slack Events API front end: verifies the request signature, acks right away,
+        drops retried event_ids and queues the bot commands for ScheduleBot.dispatch.
+        Seen event_ids are shared through the snapshot db, so replicas using the same
+        SNAPSHOT_DB drop a retry that another replica already took.
+    """
+    def __init__(self, bot, signing_secret=None, snapshot=None):
+        self.bot = bot
+        self.signing_secret = signing_secret or os.environ.get("SLACK_SIGNING_SECRET")
+        self.seen_events = LRUCache(EVENT_DEDUPE_SIZE, EVENT_DEDUPE_TTL)
+        self.seen_lock = threading.Lock()
+        self.snapshot = snapshot or SnapshotStore()
+        self.commands = Queue()
+        self.dispatcher = threading.Thread(target=self.dispatch_forever)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule('/slack/events', 'slack_events', self.handle_request, methods=['POST'])
+        self.app.add_url_rule('/metrics', 'metrics', metrics_response)
+
+    def verify(self, timestamp, signature, body):
+        if not self.signing_secret or not timestamp or not signature:
+            return False
+        try:
+            # refuse replays of old requests
+            if abs(time.time() - int(timestamp)) > EVENT_MAX_AGE:
+                return False
+        except ValueError:
+            return False
+        return hmac.compare_digest(str(slack_signature(self.signing_secret, timestamp, body)), str(signature))
+
+    def is_duplicate(self, event_id):
+        if event_id is None:
+            return False
+        with self.seen_lock:
+            if event_id in self.seen_events:
+                return True
+            self.seen_events.set(event_id, True)
+        # the first delivery may have gone to another replica
+        return not self.snapshot.claim_event(event_id)
+
+    def handle_request(self):
+        body = request.get_data()
+        if not self.verify(request.headers.get('X-Slack-Request-Timestamp'),
+                           request.headers.get('X-Slack-Signature'), body):
+            return 'invalid signature', 403
+
+        payload = json.loads(body.decode('utf-8'))
+        if payload.get('type') == 'url_verification':
+            return jsonify(challenge=payload.get('challenge'))
+
+        if request.headers.get('X-Slack-Retry-Num'):
+            # a retry is only run when no replica has taken the event yet
+            logging.info("Slack retry #%s of %s: %s", request.headers.get('X-Slack-Retry-Num'),
+                         payload.get('event_id'), request.headers.get('X-Slack-Retry-Reason'))
+        if payload.get('type') == 'event_callback' and not self.is_duplicate(payload.get('event_id')):
+            for command, channel in self.bot.parse_bot_commands([payload.get('event', {})]):
+                self.commands.put((command, channel))
+
+        # ack within Slack's 3 seconds, the commands run on the dispatcher thread
+        return '', 200
+
+    def dispatch_forever(self):
+        while True:
+            command, channel = self.commands.get()
+            try:
+                self.bot.dispatch(command, channel)
+            except Exception:
+                logging.exception("dispatch failed")
+
+
+class TaskClassifier:
+    """
+        sorts schedule tasks into the report categories of report_categories.json.
+        Every category has a case insensitive regex "pattern" on the task name, an optional
+        "project_pattern" on the project name and optional "overrides": categories that
+        don't count when this one matches (a remote enduser task is not an onsite setup).
+        All patterns are compiled into one regex that runs once over the whole task list.
+    """
+    def __init__(self, categories):
+        self.categories = categories
+        self.names = [category["name"] for category in categories]
+        self.version = hashlib.sha1(json.dumps(categories, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+        # categories sharing a pattern share its group
+        self.groups = OrderedDict()
+        for category in categories:
+            if category["pattern"] not in self.groups:
+                self.groups[category["pattern"]] = 'p{}'.format(len(self.groups))
+        # the first lookahead finds the positions where any pattern starts, then every pattern gets
+        # its own optional lookahead there, so overlapping patterns ("enduser" in "remote enduser",
+        # "enduser" and "enduser training") all match
+        self.regex = re.compile("(?=(?:{})){}".format(
+            "|".join(self.groups.keys()),
+            "".join("(?:(?=(?P<{}>{})))?".format(group, pattern) for pattern, group in self.groups.items())),
+            re.IGNORECASE)
+        self.project_regexes = dict(
+            (category["name"], re.compile(category["project_pattern"], re.IGNORECASE))
+            for category in categories if category.get("project_pattern"))
+
+    @classmethod
+    def from_file(cls, path=REPORT_CATEGORIES_FILE):
+        with open(path) as config_file:
+            return cls(json.load(config_file)["categories"])
+
+    def classify(self, tasks, get_project_name=None):
+        """
+            Returns the set of category names of every task, in the order of tasks
+        """
+        names = [task.get("name") or "" for task in tasks]
+        starts = []
+        offset = 0
+        for name in names:
+            starts.append(offset)
+            offset = offset + len(name) + 1
+        # \x00 can't be matched by a name pattern, so matches never cross two tasks
+        text = "\x00".join(names)
+
+        matched_groups = [set() for _ in tasks]
+        for match in self.regex.finditer(text):
+            matched_groups[bisect_right(starts, match.start()) - 1].update(
+                group for group, value in match.groupdict().items() if value is not None)
+
+        # tasks with the same matched patterns share the work, only project patterns
+        # need a per project check
+        resolved = {}
+        project_matches = {}
+        results = []
+        for task, groups in zip(tasks, matched_groups):
+            groups = frozenset(groups)
+            if groups not in resolved:
+                resolved[groups] = self.resolve(groups)
+            categories, project_categories = resolved[groups]
+
+            if project_categories:
+                categories = set(categories)
+                for name in project_categories:
+                    key = (name, task["project_id"])
+                    if key not in project_matches:
+                        project_name = get_project_name(task["project_id"]) if get_project_name else None
+                        project_matches[key] = project_name is not None and \
+                            self.project_regexes[name].search(project_name) is not None
+                    if project_matches[key]:
+                        categories.add(name)
+                categories = self.apply_overrides(categories)
+            results.append(categories)
+        return results
+
+    def resolve(self, groups):
+        """
+            Returns the categories matched by the name patterns alone and the
+            categories that still depend on the project name
+        """
+        categories = set()
+        project_categories = []
+        for category in self.categories:
+            if self.groups[category["pattern"]] not in groups:
+                continue
+            if category["name"] in self.project_regexes:
+                project_categories.append(category["name"])
+            else:
+                categories.add(category["name"])
+
+        if project_categories:
+            return frozenset(categories), project_categories
+        return self.apply_overrides(categories), project_categories
+
+    def apply_overrides(self, categories):
+        categories = set(categories)
+        for category in self.categories:
+            if category["name"] in categories:
+                categories.difference_update(category.get("overrides", []))
+        return frozenset(categories)
+
+
+class SlackOutbox:
+    """
+        buffers the status lines of one command and posts them as digest replies in a thread,
+        from a background thread that keeps at most one post per channel every SLACK_POST_INTERVAL.
+        Every line, posted or not, also goes to a log file that is uploaded at the end.
+    """
+    last_post = {} # channel -> time of the last post, shared by all outboxes
+    rate_lock = threading.Lock()
+
+    def __init__(self, slack_client, channel, name, interval=SLACK_DIGEST_INTERVAL, digest=True):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.name = name
+        self.interval = interval
+        # without digest nothing is posted, the status lines are kept for drain()
+        self.digest = digest
+        self.pending = deque()
+        self.lines = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread_ts = None
+        self.worker = None
+        # digests posted by the worker count towards the command that started the outbox
+        self.span = TRACER.current()
+
+    def start(self, text):
+        """
+            Posts the first message right away, the digests become replies to it
+        """
+        res = self.post(text)
+        if res and res.get('ok'):
+            self.thread_ts = res.get('ts')
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+        return self
+
+    def add(self, text):
+        with self.lock:
+            self.pending.append(text)
+            self.lines.append('{} {}'.format(datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT), text))
+
+    def log(self, text):
+        """
+            Only written to the log file
+        """
+        with self.lock:
+            self.lines.append('{} {}'.format(datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT), text))
+
+    def run(self):
+        TRACER.activate(self.span)
+        while not self.closed.wait(self.interval):
+            self.flush()
+
+    def drain(self):
+        """
+            Returns and forgets the status lines that weren't posted yet
+        """
+        with self.lock:
+            lines = list(self.pending)
+            self.pending.clear()
+        return lines
+
+    def flush(self):
+        if not self.digest:
+            return
+        lines = self.drain()
+
+        digest = []
+        size = 0
+        for line in lines:
+            if digest and size + len(line) + 1 > SLACK_DIGEST_MAX_CHARS:
+                self.post('\n'.join(digest), self.thread_ts)
+                digest = []
+                size = 0
+            digest.append(line)
+            size = size + len(line) + 1
+        if digest:
+            self.post('\n'.join(digest), self.thread_ts)
+
+    def post(self, text, thread_ts=None):
+        for attempt in range(SLACK_MAX_RETRIES + 1):
+            with SlackOutbox.rate_lock:
+                wait = SlackOutbox.last_post.get(self.channel, 0) + SLACK_POST_INTERVAL - time.time()
+                SlackOutbox.last_post[self.channel] = time.time() + max(wait, 0)
+            if wait > 0:
+                time.sleep(wait)
+
+            kwargs = {'thread_ts': thread_ts} if thread_ts else {}
+            try:
+                res = self.slack_client.api_call("chat.postMessage", channel=self.channel, text=text, **kwargs)
+            except Exception as e:
+                print('Slack post failed', e)
+                return None
+            if not res or res.get('error') != 'ratelimited':
+                return res
+            retry_after = res.get('headers', {}).get('Retry-After', 1)
+            with SlackOutbox.rate_lock:
+                SlackOutbox.last_post[self.channel] = time.time() + float(retry_after)
+        return res
+
+    def close(self, logs_dir=LOGS_DIR):
+        """
+            Posts what is still buffered and writes the full log, returns its path
+        """
+        self.closed.set()
+        if self.worker is not None:
+            self.worker.join()
+        self.flush()
+
+        if not os.path.isdir(logs_dir):
+            os.makedirs(logs_dir)
+        path = os.path.join(logs_dir, '{}-{}-{}.log'.format(
+            self.name, datetime.utcnow().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8]))
+        with open(path, 'w') as log_file:
+            for line in self.lines:
+                log_file.write(line + '\n')
+        return path
+
+
+class SalesforceSessions:
+    """
+        keeps one validated Salesforce instance per session id, so repeat commands skip
+        both the instance setup and the validation call. Describe results are cached on disk.
+    """
+    def __init__(self, ttl=SF_SESSION_TTL, describe_dir=DESCRIBE_CACHE_DIR, describe_ttl=DESCRIBE_CACHE_TTL):
+        self.sessions = LRUCache(SF_SESSION_CACHE_SIZE, ttl)
+        self.describe_dir = describe_dir
+        self.describe_ttl = describe_ttl
+
+    def get(self, session_id):
+        """
+            Returns a validated Salesforce instance, None if the session is incorrect or expired
+        """
+        sf = self.sessions.get(session_id)
+        if sf is None:
+            sf = Salesforce(instance=SALESFORCE_URL, session_id=session_id,
+                            session=GovernedSession(GOVERNOR['salesforce']))
+            sf.session.hooks['response'].append(trace_salesforce_response)
+            sf.session.hooks['response'].append(self.expire_hook(session_id))
+            if not self.validate(sf):
+                return None
+            self.sessions.set(session_id, sf)
+        return sf
+
+    def validate(self, sf):
+        # /limits is a few KB, unlike the global describe
+        try:
+            sf.query_more("/services/data/v38.0/limits/", True)
+            return True
+        except ApiBudgetExceeded:
+            # the session may be fine, the quota is not
+            raise
+        except Exception:
+            return False
+
+    def forget(self, session_id):
+        self.sessions.set(session_id, None)
+
+    def expire_hook(self, session_id):
+        """
+            Response hook that forgets the session as soon as Salesforce answers 401, whichever
+            command or thread made the call, so the next command validates it again
+        """
+        def hook(resp, *args, **kwargs):
+            if resp.status_code == 401:
+                self.forget(session_id)
+            return resp
+        return hook
+
+    def describe(self, sf, path="/services/data/v38.0/sobjects/"):
+        """
+            Describe metadata of the org, read from disk while younger than describe_ttl
+        """
+        cache_key = hashlib.sha1('{}{}'.format(SALESFORCE_URL, path).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(self.describe_dir, cache_key + '.json')
+        if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < self.describe_ttl:
+            with open(cache_path) as cache_file:
+                return json.load(cache_file)
+
+        metadata = sf.query_more(path, True)
+        if not os.path.isdir(self.describe_dir):
+            os.makedirs(self.describe_dir)
+        tmp_path = '{}.{}.part'.format(cache_path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(metadata, cache_file)
+        replace_file(tmp_path, cache_path)
+        return metadata
+
+
+class ScheduleBot(object):
     """
         slackbot class
     """
     def __init__(self):
-        # instantiate Salesforce instance
-        self.sf = None
+        # commands run on worker threads, so the Salesforce instance is per thread
+        self.command_state = threading.local()
         self.project_table_name = 'pse__Proj__c'
 
         # instantiate Slack client
-        self.slack_client = SlackClient(os.environ.get("SLACK_BOT_TOKEN"))
+        self.slack_client = TracedSlackClient(os.environ.get("SLACK_BOT_TOKEN"))
         # bot's user ID in Slack: value is assigned after the bot starts up
         self.slack_client_id = None
         # variable to count updated tasks
         self.number_of_success = 0
+        # contact cache shared by every command of this process
+        self.contacts = ContactResolver(lambda: self.sf)
+        self.jobs = JobQueue(self.run_job)
+        # validated Salesforce instances shared by the commands of the same session id
+        self.sessions = SalesforceSessions()
+        # report categories, compiled once per process
+        self.classifier = TaskClassifier.from_file()
+
+    @property
+    def sf(self):
+        return getattr(self.command_state, 'sf', None)
+
+    @sf.setter
+    def sf(self, value):
+        self.command_state.sf = value
+
+    @property
+    def session_id(self):
+        return getattr(self.command_state, 'session_id', None)
+
+    @session_id.setter
+    def session_id(self, value):
+        self.command_state.session_id = value
 
     def create_salesforce_instance(self, session_id):
+        """
+            Returns False if the session is incorrect or expired
+        """
         self.session_id = session_id
-        self.sf = Salesforce(instance=SALESFORCE_URL, session_id=session_id)
+        self.sf = self.sessions.get(session_id)
+        return self.sf is not None
 
     def set_project_table_name(self):
-        sobjects = self.sf.query_more("/services/data/v37.0/sobjects/", True)
+        sobjects = self.sessions.describe(self.sf, "/services/data/v37.0/sobjects/")
         for sobject in sobjects["sobjects"]:
             if sobject["labelPlural"] == "Projects":
-                self.project_table_name = sobject.name
+                self.project_table_name = sobject["name"]
 
 
     def parse_bot_commands(self, slack_events):
         """
             Parses a list of events coming from the Slack RTM API to find bot commands.
-            If a bot command is found, this function returns a tuple of command and channel.
-            If its not found, then this function returns None, None.
+            Returns a (command, channel) tuple for every bot command of the batch, in order.
         """
+        commands = []
         for event in slack_events:
-            if event["type"] == "message" and not "subtype" in event:
-                user_id, message = self.parse_direct_mention(event["text"])
+            if event.get("type") in ["message", "app_mention"] and not "subtype" in event:
+                user_id, message = self.parse_direct_mention(event.get("text", ""))
                 if user_id == self.slack_client_id:
-                    return message, event["channel"]
-        return None, None
+                    commands.append((message, event["channel"]))
+        return commands
 
     def parse_direct_mention(self, message_text):
         """
             Finds a direct mention (a mention that is at the beginning) in message text
             and returns the user ID which was mentioned. If there is no direct mention, returns None
         """
-        matches = re.search(MENTION_REGEX, message_text)
+        matches = MENTION_REGEX.search(message_text)
         # the first group contains the username, the second group contains the remaining message
         return (matches.group(1), matches.group(2).strip()) if matches else (None, None)
 
@@ -195,17 +1963,13 @@ class ScheduleBot:
             Executes bot command if the command is known
         """
         # Default response is help text for the user
-        default_response = "Not sure what you mean. Try *{}*.".format("sync or report")
+        default_response = "Not sure what you mean. Try {}.".format(
+            ", ".join("*{}*".format(spec["usage"]) for spec in COMMANDS.values()))
 
         # Finds and executes the given command, filling in response
         response = None
 
-        is_command_syntax_correct = False
-        for example_command in EXAMPLE_COMMANDs:
-            if command.startswith(example_command):
-                is_command_syntax_correct = True
-
-        if is_command_syntax_correct == False:
+        if command.split(" ")[0] not in COMMANDS:
             self.slack_client.api_call(
                 "chat.postMessage",
                 channel=channel,
@@ -215,21 +1979,38 @@ class ScheduleBot:
             # This is where you start to implement more commands!
             command_args = command.split(" ")
             if command_args[0] == u'report':
+                self.post_budget(channel, 'start')
                 self.get_tasks_by_weeks(channel)
                 self.slack_client.api_call(
                     "chat.postMessage",
                     channel=channel,
                     text=response or 'Upload Finished!'
                 )
+            elif command_args[0] == u'contacts':
+                stats = self.contacts.get_stats()
+                self.slack_client.api_call(
+                    "chat.postMessage",
+                    channel=channel,
+                    text='Contact cache: {} hits, {} misses ({:.0%} hit rate), {} cached, {} queries'.format(
+                        stats['hits'], stats['misses'], stats['hit_rate'], stats['cached'], stats['queries'])
+                )
+            elif command_args[0] in [u'jobs', u'status']:
+                self.post_jobs(channel)
+            elif command_args[0] == u'stats':
+                self.slack_client.api_call(
+                    "chat.postMessage",
+                    channel=channel,
+                    text=TRACER.summary() or 'No command has finished yet'
+                )
             else:
-                session_id = command_args[1]
-                self.create_salesforce_instance(session_id)
-
-                is_session_valid = True
-                try:
-                    self.sf.query_more("/services/data/v38.0/sobjects/", True)
-                except:
-                    is_session_valid = False
+                # sync resume <run> <session id> continues an interrupted sync with a fresh session
+                resume_run = None
+                if command_args[0] == u'sync' and len(command_args) > 3 and command_args[1] == u'resume':
+                    resume_run = command_args[2]
+                    session_id = command_args[3]
+                else:
+                    session_id = command_args[1]
+                is_session_valid = self.create_salesforce_instance(session_id)
 
                 if is_session_valid == False:
                     response = 'Session is incorrect or expired!'
@@ -242,216 +2023,679 @@ class ScheduleBot:
 
                     return True
                 else:
+                    self.post_budget(channel, 'start')
                     if command_args[0] == u'sync':
-                        self.sync_tasks(channel)
+                        # sync <session id> full forces a complete reconcile,
+                        # sync <session id> [full] shards <n> hands the projects to n shards
+                        full = resume_run is None and u'full' in command_args[2:]
+                        shards = 1
+                        if resume_run is None and u'shards' in command_args[2:-1]:
+                            shards = int(command_args[command_args.index(u'shards') + 1])
+                        self.sync_tasks(channel, full, resume_run, shards)
 
                     if command_args[0] == u'projectplan':
                         modified_start = command_args[2]
                         self.download_attachments(channel, modified_start)
 
 
+    def dispatch(self, command, channel):
+        """
+            Answers cheap commands right away and queues everything else on the worker pool
+        """
+        if COMMANDS.get(command.split(" ")[0], {"inline": True})["inline"]:
+            self.run_job(command, channel)
+        else:
+            job = self.jobs.submit(command, channel)
+            if job.status == 'waiting':
+                self.slack_client.api_call(
+                    "chat.postMessage",
+                    channel=channel,
+                    text='Job #{} ({}) queued behind the running job of this channel'.format(job.id, job.name())
+                )
+
+    def run_job(self, command, channel):
+        # a failing command is reported to its channel instead of taking the bot down
+        name = command.split(" ")[0]
+        inline = COMMANDS.get(name, {"inline": True})["inline"]
+        try:
+            # inline commands like stats are not kept, so stats shows the last real command
+            with TRACER.span(name, 'command', keep=not inline):
+                self.handle_command(command, channel)
+        except Exception as e:
+            logging.exception("command failed")
+            self.slack_client.api_call(
+                "chat.postMessage",
+                channel=channel,
+                text='Command {} failed: {}'.format(command.split(" ")[0], e)
+            )
+        if not inline:
+            self.post_budget(channel, 'end')
+
+    def post_budget(self, channel, when):
+        # paced like the outbox, it is posted right next to the command's own messages
+        SlackOutbox(self.slack_client, channel, 'budget').post(
+            'API budget at the {}: {}'.format(when, GOVERNOR.describe()))
+
+    def post_jobs(self, channel):
+        jobs = self.jobs.list_jobs()
+        if len(jobs) == 0:
+            text = 'No jobs running'
+        else:
+            text = '\n'.join('#{} {} {} {:.0f}s | <#{}>'.format(
+                job.id, job.status, job.name(), job.elapsed(), job.channel) for job in jobs)
+        self.slack_client.api_call(
+            "chat.postMessage",
+            channel=channel,
+            text=text
+        )
+
+    def serve_metrics(self, port=METRICS_PORT):
+        """
+            Local /metrics endpoint for Prometheus, runs next to the RTM loop
+        """
+        app = Flask(__name__)
+        app.add_url_rule('/metrics', 'metrics', metrics_response)
+        server = threading.Thread(target=app.run, kwargs={'host': '127.0.0.1', 'port': port, 'threaded': True})
+        server.daemon = True
+        server.start()
+
     def run(self):
+        if METRICS_PORT:
+            self.serve_metrics()
         if self.slack_client.rtm_connect(with_team_state=False):
             print("Starter Bot connected and running!")
             # Read bot's user ID by calling Web API method `auth.test`
             self.slack_client_id = self.slack_client.api_call("auth.test")["user_id"]
+            delay = RTM_MIN_DELAY
             while True:
                 try:
-                    command, channel = self.parse_bot_commands(self.slack_client.rtm_read())
-                    if command:
-                        self.handle_command(command, channel)
-                    time.sleep(RTM_READ_DELAY)
-                except:
+                    slack_events = self.slack_client.rtm_read()
+                except Exception as e:
+                    # only a broken RTM connection needs a reconnect
+                    print(e)
                     self.slack_client.rtm_connect(with_team_state=False)
                     self.slack_client_id = self.slack_client.api_call("auth.test")["user_id"]
+                    continue
+
+                try:
+                    commands = self.parse_bot_commands(slack_events)
+                except Exception:
+                    logging.exception("could not parse RTM events")
+                    commands = []
+                for command, channel in commands:
+                    # a failed dispatch is logged, it must not take the RTM loop down
+                    try:
+                        self.dispatch(command, channel)
+                    except Exception:
+                        logging.exception("dispatch failed")
+
+                if slack_events:
+                    # keep draining while events arrive
+                    delay = RTM_MIN_DELAY
+                else:
+                    time.sleep(delay)
+                    delay = min(delay * 2, RTM_READ_DELAY)
         else:
             print("Connection failed. Exception traceback printed above.")
 
-    def sync_tasks(self, channel):
-        self.slack_client.api_call(
-            "chat.postMessage",
-            channel=channel,
-            text='Please wait a moment...'
-        )
+    def serve_events(self, port=EVENTS_PORT):
+        """
+            Events API mode: Slack posts events to /slack/events instead of us polling RTM
+        """
+        self.slack_client_id = self.slack_client.api_call("auth.test")["user_id"]
+        receiver = EventsReceiver(self)
+        print("Starter Bot listening for events on port {}".format(port))
+        receiver.app.run(host='0.0.0.0', port=port, threaded=True)
 
-        is_session_valid = True
+    def sync_tasks(self, channel, full=False, resume_run=None, shards=1):
+        """
+            Every sync is recorded as a run in the snapshot, projects are marked done as soon as
+            their writes are flushed, so an interrupted run continues with `sync resume <run> <session id>`.
+            With shards > 1 the projects are split into shards that worker processes claim
+        """
+        # status lines are posted as digests in a thread, the full log is uploaded at the end
+        outbox = SlackOutbox(self.slack_client, channel, 'sync').start('Please wait a moment...')
 
+        response = None
+        snapshot = SnapshotStore()
         try:
-            self.sf.query_more("/services/data/v38.0/sobjects/", True)
-        except:
-            is_session_valid = False
+            # handle_command already validated the session
+            is_session_valid = self.sf is not None
 
-        test_limit = 0
+            test_limit = 0
+            float_api = FloatAPI()
+            run = None
 
-        if is_session_valid and test_limit < 10:
-            try:
-                sf_tasks = []
-                sf_project_task = SFType('pse__Project_Task__c', self.session_id, SALESFORCE_URL)
-                sf_project_task_assign = SFType('pse__Project_Task_Assignment__c', self.session_id, SALESFORCE_URL)
-                float_api = FloatAPI()
+            if is_session_valid and resume_run is not None:
+                run = snapshot.get_sync_run(resume_run)
+                if run is None or run['status'] == 'finished':
+                    is_session_valid = False
+                    response = 'Sync run #{} doesn\'t exist or is already finished'.format(resume_run)
 
-                projects = float_api.get_projects()
-                for project in projects:
+            if is_session_valid and test_limit < 10:
+                try:
+                    if run is None:
+                        checkpoint = None if full else snapshot.get_checkpoint('float_tasks')
+                        run = snapshot.get_sync_run(snapshot.create_sync_run(
+                            channel, checkpoint, datetime.utcnow().strftime(SNAPSHOT_TIME_FORMAT)))
+                    else:
+                        checkpoint = run['checkpoint']
+                    snapshot.set_sync_run_status(run['run_id'], 'running')
+                    done_projects = snapshot.get_sync_projects(run['run_id'], 'done')
+                    outbox.add('Sync run #{}{}'.format(run['run_id'],
+                        ', resuming after {} finished projects'.format(len(done_projects)) if done_projects else ''))
+
+                    float_api.load_people_directory()
+
+                    if checkpoint is None:
+                        tasks_by_project = None
+                        projects = list(float_api.iter_projects())
+                        snapshot.save_projects(projects)
+                    else:
+                        # incremental run: only the tasks modified since the last successful sync
+                        modified_since = datetime.strptime(checkpoint, SNAPSHOT_TIME_FORMAT) - SNAPSHOT_OVERLAP
+                        tasks_by_project = {}
+                        for task in float_api.get_tasks_by_params('modified_since={}'.format(
+                                quote(modified_since.strftime(SNAPSHOT_TIME_FORMAT)))):
+                            tasks_by_project.setdefault(task["project_id"], []).append(task)
+                        projects = snapshot.get_projects(tasks_by_project.keys())
+                        known_ids = set(project["project_id"] for project in projects)
+                        new_projects = [float_api.get_project_by_id(project_id)
+                                        for project_id in tasks_by_project.keys() if project_id not in known_ids]
+                        new_projects = [project for project in new_projects if project is not None]
+                        snapshot.save_projects(new_projects)
+                        projects.extend(new_projects)
+
+                    projects = [project for project in projects if project["project_id"] not in done_projects]
+
+                    summary = {'changed': 0, 'unchanged': 0, 'failed': 0}
+                    if shards > 1:
+                        self.run_shards(snapshot, run, channel, projects, shards, outbox, summary)
+                    else:
+                        self.sync_projects(snapshot, run['run_id'], projects, tasks_by_project, float_api, outbox, summary)
+
+                    # failed writes must be retried, so the checkpoint only moves after a clean run
+                    if summary['failed'] == 0:
+                        snapshot.set_checkpoint('float_tasks', run['run_started'])
+                        snapshot.set_sync_run_status(run['run_id'], 'finished')
+                        resume_hint = ''
+                    else:
+                        snapshot.set_sync_run_status(run['run_id'], 'failed')
+                        resume_hint = ' Retry the failed projects with `sync resume {} <session id>`'.format(run['run_id'])
+
+                    response = 'Finished {} sync #{}! {} changed, {} unchanged, {} failed. '\
+                        '{} people lookups served from the Float directory.{}'.format(
+                            'incremental' if tasks_by_project is not None else 'full', run['run_id'],
+                            summary['changed'], summary['unchanged'], summary['failed'],
+                            float_api.people_lookups_saved + summary.get('people_lookups_saved', 0), resume_hint)
+
+                except Exception as e:
+                    outbox.add(str(e))
+                    if run is not None:
+                        snapshot.set_sync_run_status(run['run_id'], 'interrupted')
+                        response = 'Sync #{} was interrupted, continue it with `sync resume {} <session id>`'.format(
+                            run['run_id'], run['run_id'])
+            elif response is None:
+                response = 'Session is incorrect or expired!'
+        finally:
+            # the log, the run status and the db connection must not outlive a failed run
+            log_path = outbox.close()
+            # Sends the response back to the channel
+            outbox.post(response or 'Finished!')
+            self.upload(log_path, channel, title='Sync log')
+            snapshot.close()
+
+    def sync_projects(self, snapshot, run_id, projects, tasks_by_project, float_api, outbox, summary):
+        """
+            Syncs projects through the fetch -> match -> write pipeline and adds the outcome to summary
+        """
+        # resolve the Salesforce tasks of every PR-<id> project up front, an incremental run
+        # reads the tasks synced before by their stored ids
+        sf_task_index = {}
+        if tasks_by_project is not None:
+            sf_task_index = self.prefetch_synced_tasks(snapshot, projects, tasks_by_project, float_api)
+        sf_task_index.update(self.prefetch_project_tasks(
+            ['PR-'+m.group(0) for m in (re.search(r'(?<=-)\d+', p["name"]) for p in projects)
+             if m is not None and 'PR-'+m.group(0) not in sf_task_index]
+        ))
+
+        # pipeline: Float fetch (project workers) -> match (this thread, in project order)
+        # -> Salesforce write (one writer thread) -> report (outbox)
+        match_failed = 0
+        batch = []
+        batch_projects = []
+        writes = deque()
+        with ThreadPoolExecutor(max_workers=SYNC_PROJECT_WORKERS) as fetcher, \
+                ThreadPoolExecutor(max_workers=1) as writer:
+            fetches = self.fetch_projects(fetcher, float_api, projects, tasks_by_project)
+            for project, fetch in fetches:
+                if fetch is not None:
                     m = re.search(r'(?<=-)\d+', project["name"])
-                    if m is not None:
-                        sf_project_id = m.group(0)
-                        # float_tasks = float_api.test()
-                        tmp_float_tasks = float_api.get_tasks_by_params(
-                                            'project_id={}'.format(project["project_id"])
-                                        )
-
-                        float_tasks = []
-                        float_task_hash = {}
-                        for tmp_task in tmp_float_tasks:
-                            tmp_user = float_api.get_person_by_id(tmp_task["people_id"])
-                            task_name = tmp_task["task_id"]
-                            if tmp_user['active'] == 1:
-                                tmp_task["users"] = self.format_username(tmp_user["name"])
-                                if task_name not in float_task_hash:
-                                    float_task_hash[task_name] = tmp_task
-                                    float_tasks.append(tmp_task)
-                            # else:
-                            #     first_start_date =  datetime.strptime(
-                            #         float_task_hash[task_name]["start_date"],
-                            #         '%Y-%m-%d'
-                            #     ).strftime("%V")
-                            #     second_start_date = datetime.strptime(
-                            #         tmp_task["start_date"], '%Y-%m-%d'
-                            #         ).strftime("%V")
-
-                            #     if first_start_date == second_start_date:
-                            #         float_task_hash[task_name]["users"] = self.format_username(float_task_hash[task_name]["users"]) + ', ' + self.format_username(tmp_user["name"])
-                            #     else:
-                            #         tmp_task["is_duplicate"] = True
-                            #         float_task_hash[task_name] = tmp_task
-                            #         float_tasks.append(tmp_task)
-                        # if len(float_tasks) > 0:
-                        #     if 'PR-207534' in project["name"]:
-                        #     import pdb
-                        #     pdb.set_trace()
-
-                        if len(float_tasks) > 0:
-                            # tags = float_api.get_project_by_id(float_tasks[0]["project_id"])["tags"]
-                            sf_tasks = self.get_tasks_by_project_id('PR-'+sf_project_id)                                      
-                            for float_task_key in float_task_hash.keys():
-                                # fl_user = float_api.get_person_by_id(float_task["people_id"])
-                                float_task = float_task_hash[float_task_key]
-                                if 'is_duplicate' in float_task:
-                                    project_name = 'No name'
-                                    if project and 'name' in project:
-                                        project_name = project["name"]
-
-                                    self.slack_client.api_call(
-                                        "chat.postMessage",
-                                        channel=channel,
-                                        text="Project: {} has two tasks. "\
-                                            "Please manually sync the second in Salesforce, "\
-                                            "or use a different task name".format(project["name"])
-                                    )
-                                else:
-                                    # if 'PR-207534' in project["name"]:
-                                    for sf_task in sf_tasks:
-                                        if float_task["name"] == sf_task["Name"]:
-                                            start_datetime = datetime.strptime(float_task['start_date'], '%Y-%m-%d') + timedelta(days=1)
-                                            end_datetime = datetime.strptime(float_task['end_date'], '%Y-%m-%d') + timedelta(days=1)
-
-                                            start_datetime_obj = eastern.localize(start_datetime).strftime("%Y-%m-%dT%H:%M:%S")
-                                            end_datetime_obj = eastern.localize(end_datetime).strftime("%Y-%m-%dT%H:%M:%S")
-
-                                            float_names = float_task["users"].replace('*', '').split(',')
-                                            contacts_num = len(float_names)
-                                            for username in float_names:
-                                                float_username = username.strip()
-                                                msg = ''
-                                                params = {}
-                                                # if sf_task['pse__Assigned_Resources__c'] != float_task["users"]:
-                                                params["pse__Assigned_Resources__c"] = float_username
-                                                params["pse__Assigned_Resources_Long__c"] = float_username
-                                                msg = 'assigned resources '
-
-                                                # if self.remove_delta(sf_task['pse__Start_Date_Time__c']) != start_datetime_obj.decode() or self.remove_delta(sf_task['pse__End_Date_Time__c']) != end_datetime_obj.decode():
-                                                params['pse__Start_Date_Time__c'] = start_datetime_obj
-                                                params['pse__End_Date_Time__c'] = end_datetime_obj
-                                                msg = 'start & end time '
-
-                                                contact_info = self.get_contact_id(float_username)
-                                                d_project_task_asssign = {}
-                                                if contact_info is not None:
-                                                    if contact_info['is_active']:
-                                                        d_project_task_asssign['pse__Resource__c'] = contact_info['Id']
-                                                        d_project_task_asssign['resource_lookup__c'] = contact_info['Id']
-                                                    else:
-                                                        d_project_task_asssign['pse__External_Resource__c'] = contact_info['Id']
-
-                                                    try:
-                                                        result = sf_project_task.update(sf_task["Id"], params, False)
-                                                        te_status = self.task_exist_in_assignment(sf_task["Id"])
-                                                        ta_result = None
-                                                        if te_status['is_exist']:
-                                                            if contact_info['is_active']:
-                                                                resource_id = contact_info['Id']
-                                                            else:
-                                                                resource_id = d_project_task_asssign['pse__External_Resource__c']
-                                                            if resource_id != te_status['resource_id']:
-                                                                # pdb.set_trace()
-                                                                try:
-                                                                    ta_result = sf_project_task_assign.update(te_status['Id'], d_project_task_asssign, False)
-                                                                except Exception as e:
-                                                                    print(e, project['name'], float_username, "##########")
-                                                                    task_status_response = "{}: {} | {} | project {}".format(
-                                                                        float_username,
-                                                                        'User with same role is already assgined',
-                                                                        float_task["name"],
-                                                                        project["name"])
-                                                                    self.slack_client.api_call(
-                                                                        "chat.postMessage",
-                                                                        channel=channel,
-                                                                        text=task_status_response
-                                                                    )
-                                                        else:
-                                                            # pdb.set_trace()
-                                                            d_project_task_asssign['pse__Project_Task__c'] = sf_task['Id']
-                                                            # d_project_task_asssign['pse__Project_ID__c'] = sf_task['Project_ID__c']
-                                                            ta_result = sf_project_task_assign.create(d_project_task_asssign, False)
-                                                        test_limit = test_limit + 1
-
-                                                        task_status_response = ''
-                                                        if result < 400 and ta_result is not None:
-                                                            self.number_of_success = self.number_of_success + 1
-                                                            task_status_response = "{} | {} | project {}".format(
-                                                                msg,
-                                                                float_task["name"],
-                                                                project["name"])
-                                                            self.slack_client.api_call(
-                                                                "chat.postMessage",
-                                                                channel=channel,
-                                                                text=task_status_response
-                                                            )
-                                                    except Exception as e:
-                                                        print(e)
-                                                        continue
-                                                else:
-                                                    self.slack_client.api_call(
-                                                        "chat.postMessage",
-                                                        channel=channel,
-                                                        text='Contact: {} doesn\'t exist'.format(float_username) 
-                                                    )
+                    sf_project_id = m.group(0)
+                    try:
+                        tmp_float_tasks = fetch.result()
+                        with TRACER.span('match ' + project["name"], 'project'):
+                            batch.extend(self.plan_project(
+                                project, sf_project_id, tmp_float_tasks, float_api, sf_task_index, outbox))
+                    except ApiBudgetExceeded:
+                        # stops the whole run, it is resumed once the budget is back
+                        raise
+                    except Exception as e:
+                        # the project stays open in the run and is retried on resume
+                        match_failed = match_failed + 1
+                        snapshot.set_sync_projects(run_id, [project["project_id"]], 'failed', str(e))
+                        outbox.add('Project {} failed: {}'.format(project["name"], e))
+                        continue
+                batch_projects.append(project["project_id"])
+
+                # send the planned task updates and assignment upserts in as few requests as possible
+                if len(batch) >= SF_COLLECTION_SIZE:
+                    writes.append(writer.submit(self.in_command, self.command_context(),
+                        self.flush_sync_batch, snapshot, run_id, batch, batch_projects, outbox, summary))
+                    batch = []
+                    batch_projects = []
+                    # one batch is written while the next one is matched
+                    while len(writes) > 1:
+                        writes.popleft().result()
+            writes.append(writer.submit(self.in_command, self.command_context(),
+                self.flush_sync_batch, snapshot, run_id, batch, batch_projects, outbox, summary))
+            while writes:
+                writes.popleft().result()
+        summary['failed'] = summary['failed'] + match_failed
+
+    def run_shards(self, snapshot, run, channel, projects, shard_count, outbox, summary):
+        """
+            Splits projects into shards by project_id, queues them and works on them until every
+            shard is done or given up; `python slackbot.py worker` processes claim shards too.
+            The shard results are added to summary.
+        """
+        shards = [[] for _ in range(shard_count)]
+        for project in projects:
+            shards[shard_of(project["project_id"], shard_count)].append(project["project_id"])
+        shards = [project_ids for project_ids in shards if project_ids]
+        snapshot.create_shards(run['run_id'], shards, self.session_id, channel)
+        try:
+            outbox.add('Sync run #{} split into {} shards, add workers with `python slackbot.py worker`'.format(
+                run['run_id'], len(shards)))
 
-            except Exception as e:
-                self.slack_client.api_call(
-                    "chat.postMessage",
-                    channel=channel,
-                    text=e.message
-                )
-        else:
-            response = 'Session is incorrect or expired!'
+            finished = set()
+            while True:
+                # working on its own shards lets the run finish even without worker processes
+                owner = worker_name()
+                shard = snapshot.claim_shard(owner, run['run_id'])
+                if shard is not None:
+                    self.run_shard(snapshot, shard, owner)
+
+                snapshot.expire_shards(run['run_id'])
+                states = snapshot.get_shards(run['run_id'])
+                for state in states:
+                    if state['status'] in ('done', 'failed') and state['shard'] not in finished:
+                        finished.add(state['shard'])
+                        # the shard's status lines and task outcomes, as a single process would report them
+                        for line in (state['result'] or {}).get('messages', []):
+                            outbox.add(line)
+                        records = snapshot.get_sync_records(run['run_id'], state['project_ids'])
+                        for task_id, outcome, message in records:
+                            if outcome == 'unchanged':
+                                outbox.log(message)
+                        outbox.add('{}/{} shards finished, shard {} {}: {} projects{}'.format(
+                            len(finished), len(states), state['shard'], state['status'], len(state['project_ids']),
+                            ', ' + state['error'] if state['error'] else ''))
+                if len(finished) == len(states):
+                    break
+                if shard is None:
+                    time.sleep(SHARD_POLL_INTERVAL)
+
+            for state in states:
+                if state['status'] == 'done':
+                    for key, value in state['result'].items():
+                        if key != 'messages':
+                            summary[key] = summary.get(key, 0) + value
+                else:
+                    summary['failed'] = summary['failed'] + len(state['project_ids'])
+        finally:
+            # the session id is stored in plain text, it must not stay in the db
+            snapshot.clear_shard_sessions(run['run_id'])
 
-        # Sends the response back to the channel
-        self.slack_client.api_call(
-            "chat.postMessage",
-            channel=channel,
-            text=response or 'Finished!'
-        )
+    def run_shard(self, snapshot, shard, owner):
+        """
+            Syncs the projects of a claimed shard while a heartbeat keeps the lease,
+            a failed shard goes back to the queue for the next attempt
+        """
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(SHARD_LEASE / 3.0):
+                if not snapshot.renew_shard(shard, owner):
+                    break
+
+        keeper = threading.Thread(target=heartbeat)
+        keeper.daemon = True
+        keeper.start()
+        # nothing is posted from here, the requesting process reports the shard's lines
+        outbox = SlackOutbox(self.slack_client, shard['channel'], 'shard', digest=False)
+        retry = True
+        try:
+            with TRACER.span('shard {}/{}'.format(shard['run_id'], shard['shard'])):
+                # the session id is cleared once the requesting process gave up on the run
+                if not shard['session_id'] or not self.create_salesforce_instance(shard['session_id']):
+                    retry = False
+                    raise Exception('Session is incorrect or expired!')
+                float_api = FloatAPI()
+                float_api.load_people_directory()
+                summary = {'changed': 0, 'unchanged': 0, 'failed': 0}
+                self.sync_projects(snapshot, shard['run_id'], snapshot.get_projects(shard['project_ids']),
+                                   None, float_api, outbox, summary)
+                summary['people_lookups_saved'] = float_api.people_lookups_saved
+            summary['messages'] = outbox.drain()
+            snapshot.finish_shard(shard, owner, 'done', summary)
+        except Exception as e:
+            logging.exception("shard failed")
+            outbox.log('Shard {}/{} failed: {}'.format(shard['run_id'], shard['shard'], e))
+            # a spent API budget or an expired session fails every other attempt as well
+            if isinstance(e, (ApiBudgetExceeded, SalesforceExpiredSession)):
+                retry = False
+            snapshot.finish_shard(shard, owner,
+                                  'queued' if retry and shard['attempts'] < SHARD_MAX_ATTEMPTS else 'failed',
+                                  {'messages': outbox.drain()}, str(e))
+        finally:
+            stop.set()
+            keeper.join()
+            outbox.close()
+
+    def work_shards(self):
+        """
+            Worker mode: claims and syncs shards of any run until the process is stopped
+        """
+        snapshot = SnapshotStore()
+        print("Sync worker {} waiting for shards".format(worker_name()))
+        while True:
+            owner = worker_name()
+            shard = snapshot.claim_shard(owner)
+            if shard is None:
+                time.sleep(SHARD_POLL_INTERVAL)
+                continue
+            print("Working on shard {} of sync run #{}".format(shard['shard'], shard['run_id']))
+            self.run_shard(snapshot, shard, owner)
+
+    def fetch_projects(self, executor, float_api, projects, tasks_by_project):
+        """
+            Yields (project, future of its Float tasks) in project order, with at most SYNC_FETCH_AHEAD
+            fetches in flight. The future is None for projects without a PR-<id>.
+        """
+        pending = deque()
+        for project in projects:
+            fetch = None
+            if re.search(r'(?<=-)\d+', project["name"]) is not None:
+                fetch = executor.submit(self.in_command, self.command_context(),
+                                        self.fetch_project, float_api, project, tasks_by_project)
+            pending.append((project, fetch))
+            if len(pending) >= SYNC_FETCH_AHEAD:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def fetch_project(self, float_api, project, tasks_by_project):
+        """
+            Returns the Float tasks of a project and warms the contact cache with their
+            assignees, so matching the project doesn't wait on Salesforce
+        """
+        with TRACER.span('fetch ' + project["name"], 'project'):
+            # float_tasks = float_api.test()
+            if tasks_by_project is not None:
+                tmp_float_tasks = tasks_by_project[project["project_id"]]
+            else:
+                tmp_float_tasks = float_api.get_tasks_by_params(
+                                    'project_id={}'.format(project["project_id"])
+                                )
+
+            usernames = set()
+            for tmp_task in tmp_float_tasks:
+                tmp_user = float_api.people_by_id.get(tmp_task["people_id"])
+                if tmp_user is not None and tmp_user['active'] == 1:
+                    usernames.update(username.strip() for username in
+                                     self.format_username(tmp_user["name"]).replace('*', '').split(','))
+            self.contacts.resolve_names(usernames)
+            return tmp_float_tasks
+
+    def command_context(self):
+        # what a helper thread needs to continue the running command
+        return self.sf, self.session_id, TRACER.current()
+
+    def in_command(self, context, func, *args):
+        """
+            Runs func on a helper thread with the Salesforce session and span of the command that started it
+        """
+        self.sf, self.session_id, span = context
+        return TRACER.within(span, func, *args)
+
+    def flush_sync_batch(self, snapshot, run_id, batch, batch_projects, outbox, summary):
+        """
+            Writes the planned changes of batch_projects, records the outcome of every task
+            and marks the projects without failures as done in the run
+        """
+        with TRACER.span('write batch of {} projects'.format(len(batch_projects))):
+            batch_summary = self.write_planned_tasks(batch, outbox)
+            for key in summary:
+                summary[key] = summary[key] + batch_summary[key]
+            snapshot.save_sf_ids([
+                (item['float_task']['task_id'], item['sf_task']['Id'], item['assignment_id'])
+                for item in batch if 'assignment_id' in item
+            ])
+            outcomes = [item for item in batch if 'outcome' in item]
+            snapshot.save_sync_records(run_id, [
+                (item['project']['project_id'], item['float_task']['task_id'], item['sf_task']['Id'],
+                 item['outcome'], item['outcome_message'])
+                for item in outcomes
+            ])
+            failed_projects = set(item['project']['project_id'] for item in outcomes if item['outcome'] == 'failed')
+            snapshot.set_sync_projects(run_id, [p for p in batch_projects if p not in failed_projects], 'done')
+            snapshot.set_sync_projects(run_id, [p for p in batch_projects if p in failed_projects], 'failed')
+
+    def plan_project(self, project, sf_project_id, tmp_float_tasks, float_api, sf_task_index, outbox):
+        """
+            Returns the desired Salesforce state of the tasks of one Float project
+        """
+        planned_writes = []
+        float_tasks = []
+        float_task_hash = {}
+        for tmp_task in tmp_float_tasks:
+            tmp_user = float_api.get_person(tmp_task["people_id"])
+            task_name = tmp_task["task_id"]
+            if tmp_user is not None and tmp_user['active'] == 1:
+                tmp_task["users"] = self.format_username(tmp_user["name"])
+                if task_name not in float_task_hash:
+                    float_task_hash[task_name] = tmp_task
+                    float_tasks.append(tmp_task)
+            # else:
+            #     first_start_date =  datetime.strptime(
+            #         float_task_hash[task_name]["start_date"],
+            #         '%Y-%m-%d'
+            #     ).strftime("%V")
+            #     second_start_date = datetime.strptime(
+            #         tmp_task["start_date"], '%Y-%m-%d'
+            #         ).strftime("%V")
+
+            #     if first_start_date == second_start_date:
+            #         float_task_hash[task_name]["users"] = self.format_username(float_task_hash[task_name]["users"]) + ', ' + self.format_username(tmp_user["name"])
+            #     else:
+            #         tmp_task["is_duplicate"] = True
+            #         float_task_hash[task_name] = tmp_task
+            #         float_tasks.append(tmp_task)
+        # if len(float_tasks) > 0:
+        #     if 'PR-207534' in project["name"]:
+        #     import pdb
+        #     pdb.set_trace()
+
+        if len(float_tasks) > 0:
+            # tags = float_api.get_project_by_id(float_tasks[0]["project_id"])["tags"]
+            sf_tasks = sf_task_index.get('PR-'+sf_project_id, {})
+            # resolve every assignee of the project in one batch
+            self.contacts.resolve_names(set(
+                username.strip()
+                for float_task in float_tasks
+                for username in float_task["users"].replace('*', '').split(',')
+            ))
+            for float_task_key in float_task_hash.keys():
+                # fl_user = float_api.get_person_by_id(float_task["people_id"])
+                float_task = float_task_hash[float_task_key]
+                if 'is_duplicate' in float_task:
+                    project_name = 'No name'
+                    if project and 'name' in project:
+                        project_name = project["name"]
+
+                    outbox.add("Project: {} has two tasks. "\
+                        "Please manually sync the second in Salesforce, "\
+                        "or use a different task name".format(project["name"]))
+                else:
+                    for sf_task in sf_tasks.get(float_task["name"], []):
+                        start_datetime = datetime.strptime(float_task['start_date'], '%Y-%m-%d') + timedelta(days=1)
+                        end_datetime = datetime.strptime(float_task['end_date'], '%Y-%m-%d') + timedelta(days=1)
+
+                        start_datetime_obj = eastern.localize(start_datetime).strftime("%Y-%m-%dT%H:%M:%S")
+                        end_datetime_obj = eastern.localize(end_datetime).strftime("%Y-%m-%dT%H:%M:%S")
+
+                        float_names = float_task["users"].replace('*', '').split(',')
+                        for username in float_names:
+                            float_username = username.strip()
+                            # desired state, write_planned_tasks only sends what differs
+                            params = {
+                                "pse__Assigned_Resources__c": float_username,
+                                "pse__Assigned_Resources_Long__c": float_username,
+                                "pse__Start_Date_Time__c": start_datetime_obj,
+                                "pse__End_Date_Time__c": end_datetime_obj
+                            }
+
+                            contact_info = self.get_contact_id(float_username)
+                            if contact_info is not None:
+                                planned_writes.append({
+                                    'project': project,
+                                    'float_task': float_task,
+                                    'sf_task': sf_task,
+                                    'username': float_username,
+                                    'contact': contact_info,
+                                    'params': params
+                                })
+                            else:
+                                outbox.add('Contact: {} doesn\'t exist'.format(float_username))
+        return planned_writes
+
+    def write_planned_tasks(self, planned_writes, outbox):
+        """
+            Compares the planned Float state with the fetched Salesforce tasks and assignments,
+            flushes only the real changes through sObject Collections and adds the outcome to the outbox.
+            Returns the number of changed, unchanged and failed tasks.
+        """
+        # the last assignee planned for a task wins, like it did with sequential updates
+        planned_by_task = OrderedDict()
+        for item in planned_writes:
+            planned_by_task.pop(item['sf_task']['Id'], None)
+            planned_by_task[item['sf_task']['Id']] = item
+
+        write_queue = SalesforceWriteQueue(self.sf)
+        assignments = self.get_task_assignments(planned_by_task.keys())
+
+        for task_id, item in planned_by_task.items():
+            contact_info = item['contact']
+            d_project_task_asssign = {}
+            if contact_info['is_active']:
+                resource_field = 'pse__Resource__c'
+                d_project_task_asssign['resource_lookup__c'] = contact_info['Id']
+            else:
+                # inactive people are assigned by username
+                resource_field = 'pse__External_Resource__c'
+            d_project_task_asssign[resource_field] = contact_info['Id']
+
+            changes = self.task_changes(item['sf_task'], item['params'])
+            item['msg'] = self.change_message(changes)
+            item['task_write'] = None
+            if changes:
+                item['task_write'] = write_queue.update('pse__Project_Task__c', task_id, changes)
+
+            item['assignment_write'] = None
+            assignment = assignments.get(task_id)
+            item['assignment_id'] = assignment['Id'] if assignment is not None else None
+            if assignment is not None:
+                if contact_info['Id'] != assignment[resource_field]:
+                    item['assignment_write'] = write_queue.update(
+                        'pse__Project_Task_Assignment__c', assignment['Id'], d_project_task_asssign)
+            else:
+                d_project_task_asssign['pse__Project_Task__c'] = task_id
+                item['assignment_write'] = write_queue.create(
+                    'pse__Project_Task_Assignment__c', d_project_task_asssign)
+
+            if item['assignment_write'] is not None and not changes:
+                item['msg'] = 'assignment '
+
+        results = write_queue.flush()
+
+        summary = {'changed': 0, 'unchanged': 0, 'failed': 0}
+        for item in planned_by_task.values():
+            if item['task_write'] is None and item['assignment_write'] is None:
+                summary['unchanged'] = summary['unchanged'] + 1
+                item['outcome'] = 'unchanged'
+                item['outcome_message'] = "unchanged | {} | project {}".format(
+                    item['float_task']["name"], item['project']["name"])
+                outbox.log(item['outcome_message'])
+                continue
+
+            task_result = results.get(item['task_write'], {'success': True})
+            assignment_result = results.get(item['assignment_write'], {'success': True})
+            if item['assignment_id'] is None and assignment_result['success']:
+                item['assignment_id'] = assignment_result.get('id')
+            if task_result['success'] and assignment_result['success']:
+                summary['changed'] = summary['changed'] + 1
+                self.number_of_success = self.number_of_success + 1
+                task_status_response = "{} | {} | project {}".format(
+                    item['msg'],
+                    item['float_task']["name"],
+                    item['project']["name"])
+            elif not task_result['success']:
+                summary['failed'] = summary['failed'] + 1
+                logging.warning("task write failed: %s (%s, %s)",
+                                write_errors(task_result), item['project']['name'], item['username'])
+                task_status_response = "{}: {} | {} | project {}".format(
+                    item['username'],
+                    write_errors(task_result),
+                    item['float_task']["name"],
+                    item['project']["name"])
+            else:
+                summary['failed'] = summary['failed'] + 1
+                logging.warning("assignment write failed: %s (%s, %s)",
+                                write_errors(assignment_result), item['project']['name'], item['username'])
+                task_status_response = "{}: {} | {} | project {}".format(
+                    item['username'],
+                    'User with same role is already assgined',
+                    item['float_task']["name"],
+                    item['project']["name"])
+            item['outcome'] = 'changed' if task_result['success'] and assignment_result['success'] else 'failed'
+            item['outcome_message'] = task_status_response
+            outbox.add(task_status_response)
+
+        return summary
+
+    def task_changes(self, sf_task, params):
+        """
+            Returns the fields of params whose value differs from the Salesforce task.
+            Date times are compared without the milliseconds and the +0000 offset.
+        """
+        changes = {}
+        for field, value in params.items():
+            current = sf_task.get(field)
+            if field in SF_DATETIME_FIELDS:
+                current = self.format_time(self.remove_delta(current))
+                value = self.format_time(self.remove_delta(value))
+            if current != value:
+                changes[field] = params[field]
+        return changes
+
+    def change_message(self, changes):
+        parts = []
+        if 'pse__Assigned_Resources__c' in changes or 'pse__Assigned_Resources_Long__c' in changes:
+            parts.append('assigned resources')
+        if 'pse__Start_Date_Time__c' in changes or 'pse__End_Date_Time__c' in changes:
+            parts.append('start & end time')
+        return ' & '.join(parts) + ' '
 
     def download_attachments(self, channel, modified_time):
         self.slack_client.api_call(
@@ -466,38 +2710,40 @@ class ScheduleBot:
                 'Marie Alberal', 'Michelle Lee', 'Scott Badger',
                 'Susan Fulmer', 'Tiffany Vance-Huffman']
 
-        # Get projects that contains "ATLAS"
+        # Get projects that contains "ATLAS" owned by an active resource of OWNERS,
+        # the owner comes along through the Assigned_Owner__r relationship
         try:
             search_key = "ATLAS"
-            query =  "select Id, Name, Assigned_Owner__c from pse__Proj__c where Name like '%{}%'".format(search_key)
-            projects = self.sf.query(query)
-
+            projects = self.query("select Id, Name, Assigned_Owner__c, Assigned_Owner__r.Name from pse__Proj__c \
+                where Name like {} and Assigned_Owner__r.Name in {} \
+                and Assigned_Owner__r.pse__Is_Resource__c = true \
+                and Assigned_Owner__r.pse__Is_Resource_Active__c = true", '%' + search_key + '%', OWNERS)
+            projects_by_id = OrderedDict((project['Id'], project) for project in projects)
 
             csv_data = []
-            if projects["totalSize"] > 0:
-                for project in projects["records"]:
-                    # Get owner
-
-                    if project['Assigned_Owner__c']:
-                        contact = self.get_contact_by_id(project['Assigned_Owner__c'])
-                        print('Contact: ', contact)
-                        if contact and contact in OWNERS:
-                            start_datetime = datetime.strptime(modified_time, '%Y-%m-%d') + timedelta(days=1)
-                            start_datetime_obj = eastern.localize(start_datetime).strftime("%Y-%m-%dT%H:%M:%S.000+0000")
-
-                            attachment_query = "select Id, Name, LastModifiedDate from Attachment where (ParentId = '{}' and \
-                                Name like '%.xls%' and LastModifiedDate > {})".format(project['Id'], start_datetime_obj)
-                            attachments = self.sf.query(attachment_query)
-
-                            if attachments["totalSize"] > 0:
-                                for attachment in attachments["records"]:
-                                    csv_data.append({
-                                        'resource_name': contact,
-                                        'project_name': project['Name'],
-                                        'doc_id': attachment['Id'],
-                                        'attachment_name': attachment['Name'],
-                                        'last_modiled_date': attachment['LastModifiedDate'],
-                                        'attachment_url': DOWNLOAD_LINK+attachment['Id']})
+            if len(projects_by_id) > 0:
+                start_datetime = datetime.strptime(modified_time, '%Y-%m-%d') + timedelta(days=1)
+                start_datetime_obj = eastern.localize(start_datetime).strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+
+                # attachments of every project with chunked ParentId IN (...) queries
+                attachments_by_project = {}
+                for chunk in chunks(list(projects_by_id.keys()), SOQL_IN_CHUNK_SIZE):
+                    attachments = self.query("select Id, Name, ParentId, LastModifiedDate from Attachment \
+                        where ParentId in {} and Name like '%.xls%' and LastModifiedDate > {:literal}",
+                        chunk, start_datetime_obj)
+                    for attachment in attachments:
+                        attachments_by_project.setdefault(attachment['ParentId'], []).append(attachment)
+
+                for project_id, project in projects_by_id.items():
+                    contact = project['Assigned_Owner__r']['Name']
+                    for attachment in attachments_by_project.get(project_id, []):
+                        csv_data.append({
+                            'resource_name': contact,
+                            'project_name': project['Name'],
+                            'doc_id': attachment['Id'],
+                            'attachment_name': attachment['Name'],
+                            'last_modiled_date': attachment['LastModifiedDate'],
+                            'attachment_url': DOWNLOAD_LINK+attachment['Id']})
 
                 fieldnames = ['resource_name', 'project_name', 'attachment_id',
                                 'attachment_name', 'attachment_url', 'last_modiled_date']
@@ -513,20 +2759,9 @@ class ScheduleBot:
                             'last_modiled_date': self.validate_text(cdata['last_modiled_date'].replace('.000+0000', '')),
                             'attachment_url': self.validate_text(cdata['attachment_url'])})
 
-                        doc_id = cdata['doc_id']
-                        doc_name = self.sf.Attachment.get(doc_id)['Name']
-                        download_url = 'https://{base_url}/services/data/v47.0/sobjects/Attachment/{doc_id}/body'.format(
-                            doc_id=doc_id, base_url=SALESFORCE_URL)
-                        result = self.sf.session.get(download_url,
-                                                    headers=self.sf.headers,stream=True)
-
-                        with open('./excels/'+self.validate_text(cdata['attachment_name']),'wb+') as file:
-                            #retrieve the bytes from the resources incrementally 
-                            for chunk in result.iter_content(1000):
-                                file.write(chunk)
-                        file.close()
                     csv_file.close()
 
+                self.download_all(channel, csv_data)
                 self.upload(report_str, channel)
 
 
@@ -540,16 +2775,191 @@ class ScheduleBot:
             self.slack_client.api_call(
                 "chat.postMessage",
                 channel=channel,
-                text=e.message
+                text=str(e)
             )
 
+    def download_all(self, channel, csv_data):
+        """
+            Downloads the attachments on a bounded pool of streaming downloads.
+            Attachments already downloaded with the same LastModifiedDate are skipped and
+            the progress is kept up to date in a single Slack message.
+        """
+        if not os.path.isdir(EXCELS_DIR):
+            os.makedirs(EXCELS_DIR)
+
+        snapshot = SnapshotStore()
+        downloads = []
+        for cdata in csv_data:
+            path = os.path.join(EXCELS_DIR, self.validate_text(cdata['attachment_name']))
+            downloaded = snapshot.get_attachment(cdata['doc_id'])
+            if downloaded is not None and downloaded['last_modified'] == cdata['last_modiled_date'] \
+                    and os.path.exists(downloaded['path']):
+                continue
+            downloads.append((cdata, path))
+
+        progress = self.slack_client.api_call(
+            "chat.postMessage",
+            channel=channel,
+            text='Downloading {} attachments ({} already up to date)...'.format(
+                len(downloads), len(csv_data) - len(downloads))
+        )
+
+        started = time.time()
+        last_update = started
+        done = 0
+        failed = 0
+        total_bytes = 0
+        executor = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS)
+        try:
+            futures = dict((executor.submit(self.in_command, self.command_context(),
+                                            self.download_attachment, cdata['doc_id'], path), (cdata, path))
+                           for cdata, path in downloads)
+            for future in as_completed(futures):
+                cdata, path = futures[future]
+                try:
+                    total_bytes = total_bytes + future.result()
+                    snapshot.save_attachment(cdata['doc_id'], cdata['last_modiled_date'], path)
+                    done = done + 1
+                except Exception as e:
+                    print(e, cdata['attachment_name'])
+                    failed = failed + 1
+
+                if time.time() - last_update >= ATTACHMENT_PROGRESS_INTERVAL:
+                    last_update = time.time()
+                    self.update_download_progress(channel, progress, done, failed, len(downloads),
+                                                  total_bytes, last_update - started)
+        finally:
+            executor.shutdown(wait=True)
+            snapshot.close()
+
+        self.update_download_progress(channel, progress, done, failed, len(downloads),
+                                      total_bytes, time.time() - started)
+
+    def download_attachment(self, doc_id, path):
+        """
+            Streams one attachment body into a temp file that is renamed into place once complete.
+            Returns the number of bytes written
+        """
+        download_url = 'https://{base_url}/services/data/v47.0/sobjects/Attachment/{doc_id}/body'.format(
+            doc_id=doc_id, base_url=SALESFORCE_URL)
+        result = self.sf.session.get(download_url, headers=self.sf.headers, stream=True)
+        tmp_path = '{}.{}.part'.format(path, uuid.uuid4().hex)
+        size = 0
+        try:
+            result.raise_for_status()
+            # the response hook only timed the headers, the body is streamed here
+            with TRACER.call('salesforce', salesforce_endpoint('GET', download_url) + ' download'), \
+                    open(tmp_path, 'wb') as file:
+                #retrieve the bytes from the resources incrementally
+                for chunk in result.iter_content(ATTACHMENT_CHUNK_SIZE):
+                    file.write(chunk)
+                    size = size + len(chunk)
+            replace_file(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            result.close()
+        return size
+
+    def update_download_progress(self, channel, progress, done, failed, total, total_bytes, elapsed):
+        text = 'Downloaded {}/{} attachments{}, {:.1f} MB in {:.0f}s ({:.2f} MB/s)'.format(
+            done, total, ', {} failed'.format(failed) if failed else '',
+            total_bytes / 1048576.0, elapsed, total_bytes / 1048576.0 / elapsed if elapsed > 0 else 0.0)
+        if progress and progress.get('ts'):
+            self.slack_client.api_call("chat.update", channel=progress.get('channel', channel),
+                                      ts=progress['ts'], text=text)
+        else:
+            self.slack_client.api_call("chat.postMessage", channel=channel, text=text)
+
     def validate_text(self, text):
-        return unicode(text).encode('utf-8')
+        # the csv module and file names of Python 2 want utf-8 bytes
+        text = text_type(text)
+        return text.encode('utf-8') if str is bytes else text
 
 
+    def query(self, soql, *args, **kwargs):
+        """
+            Streams the records of a SOQL query, {} placeholders are filled with escaped literals
+        """
+        return iter_query(self.sf, format_soql(soql, *args, **kwargs))
+
+    def prefetch_project_tasks(self, project_ids, milestone_name='Implementation and Training'):
+        """
+            Resolves the projects, milestones and tasks of every PR-<id> with a few
+            chunked IN (...) queries instead of 4 + N calls per project.
+            Returns {project_id: {task name: [task, ...]}}
+        """
+        project_ids = sorted(set(project_ids))
+        index = {}
+
+        # PR-<id> -> pse__Proj__c Id
+        global_project_ids = {}
+        for chunk in chunks(project_ids, SOQL_IN_CHUNK_SIZE):
+            records = self.query("select Id, pse__Project_ID__c from pse__Proj__c \
+                where pse__Project_ID__c in {}", chunk)
+            for record in records:
+                if record['pse__Project_ID__c'] not in global_project_ids:
+                    global_project_ids[record['pse__Project_ID__c']] = record['Id']
+        project_ids_by_global_id = dict((v, k) for k, v in global_project_ids.items())
+
+        # pse__Proj__c Id -> milestone Id
+        milestone_ids = {}
+        for chunk in chunks(sorted(project_ids_by_global_id.keys()), SOQL_IN_CHUNK_SIZE):
+            records = self.query("select Id, pse__Project__c from pse__Milestone__c \
+                where Name={} and pse__Project__c in {}", milestone_name, chunk)
+            for record in records:
+                if record['pse__Project__c'] not in milestone_ids:
+                    milestone_ids[record['pse__Project__c']] = record['Id']
+
+        for chunk in chunks(sorted(milestone_ids.values()), SOQL_IN_CHUNK_SIZE):
+            records = self.query("select {:literal} from pse__Project_Task__c \
+                where pse__Milestone__c in {}", ', '.join(SF_TASK_FIELDS), chunk)
+            for record in records:
+                if milestone_ids.get(record['pse__Project__c']) != record['pse__Milestone__c']:
+                    continue
+                project_id = project_ids_by_global_id[record['pse__Project__c']]
+                index.setdefault(project_id, {}).setdefault(record['Name'], []).append(record)
+
+        return index
+
+    def prefetch_synced_tasks(self, snapshot, projects, tasks_by_project, float_api):
+        """
+            Reads the Salesforce tasks of the modified Float tasks by the ids stored at their last sync.
+            Returns the prefetch_project_tasks index for the projects whose tasks were all synced
+            before under the same name, the other projects need the full prefetch.
+        """
+        float_tasks_by_pr = {}
+        for project in projects:
+            m = re.search(r'(?<=-)\d+', project["name"])
+            if m is not None:
+                # tasks of people inactive in Float are never written, so they have no stored ids
+                float_tasks_by_pr['PR-'+m.group(0)] = [
+                    task for task in tasks_by_project.get(project["project_id"], [])
+                    if (float_api.people_by_id.get(task["people_id"]) or {}).get('active') == 1]
+
+        sf_ids = snapshot.get_sf_ids(task["task_id"] for tasks in float_tasks_by_pr.values() for task in tasks)
+        records = {}
+        for chunk in chunks(sorted(set(ids['sf_task_id'] for ids in sf_ids.values())), SOQL_IN_CHUNK_SIZE):
+            for record in self.query("select {:literal} from pse__Project_Task__c where Id in {}",
+                                     ', '.join(SF_TASK_FIELDS), chunk):
+                records[record['Id']] = record
+
+        index = {}
+        for pr_id, float_tasks in float_tasks_by_pr.items():
+            tasks = {}
+            for float_task in float_tasks:
+                record = records.get((sf_ids.get(float_task["task_id"]) or {}).get('sf_task_id'))
+                if record is None or record['Name'] != float_task["name"]:
+                    tasks = None
+                    break
+                tasks[record['Name']] = [record]
+            if tasks is not None:
+                index[pr_id] = tasks
+        return index
+
     def get_tasks_by_project_id(self, project_id):
-        sobject = self.sf.query_more("/services/data/v38.0/sobjects/pse__Proj__c", True)
-        projects = sobject["recentItems"]
         tasks = []
 
         milestone_obj = self.get_milestone_id(project_id)
@@ -563,7 +2973,7 @@ class ScheduleBot:
             for task in sf_tasks:
                 formatted_task = self.get_detail_task(task["attributes"]["url"])
                 tasks.append(formatted_task)
-        
+
         return tasks
 
     
@@ -573,77 +2983,57 @@ class ScheduleBot:
 
 
     def get_milestone_id(self, project_id, milestone_name='Implementation and Training'):
-        query = "select Id, Name from pse__Proj__c where pse__Project_ID__c='{}'".format(project_id)
-
-        sobject = self.sf.query(query)
-
-        if sobject["totalSize"] == 0:
+        project = next(self.query(
+            "select Id, Name from pse__Proj__c where pse__Project_ID__c={} limit 1", project_id), None)
+        if project is None:
             return None
 
-        global_project_id = sobject["records"][0]['Id']
+        global_project_id = project['Id']
 
-        query = "select Id, Name from pse__Milestone__c \
-                where pse__Project__c='{}' and Name='{}'".format(global_project_id, milestone_name)
-        
-        sobject = self.sf.query(query)
-        if sobject["totalSize"] == 0:
+        milestone = next(self.query("select Id, Name from pse__Milestone__c \
+                where pse__Project__c={} and Name={} limit 1", global_project_id, milestone_name), None)
+        if milestone is None:
             return None
 
         return {
-            'milestone_id': sobject["records"][0]['Id'],
+            'milestone_id': milestone['Id'],
             'project_id': global_project_id
         }
 
 
     def get_task_by_milestone_and_product(self, project_id, milestone_id):
-        query = "select Id, pse__Project__c from pse__Project_Task__c \
-                where (pse__Project__c='{}' and pse__Milestone__c='{}')".format(project_id, milestone_id)
-
-        sobject = self.sf.query(query)
-        if sobject["totalSize"] == 0:
-            return []
-
-        return sobject["records"]
+        return list(self.query("select Id, pse__Project__c from pse__Project_Task__c \
+                where (pse__Project__c={} and pse__Milestone__c={})", project_id, milestone_id))
 
     def get_contact_by_id(self, id):
-        query = "select Id, Name, pse__Is_Resource__c, pse__Is_Resource_Active__c from Contact where Id='{}'".format(id)
-        result = self.sf.query(query)
-        if result['totalSize'] == 0:
-            return None
-
-        if result['records'][0]['pse__Is_Resource__c'] == True and result['records'][0]['pse__Is_Resource_Active__c']:
-            return result['records'][0]['Name']
-
+        return self.contacts.resolve_ids([id])[id]
 
     def get_contact_id(self, username):
-        query = "select Id, Name, pse__Is_Resource__c, pse__Is_Resource_Active__c from Contact where name='{}'".format(username)
-        result = self.sf.query(query)
-        if result['totalSize'] == 0:
-            return None
+        return self.contacts.resolve_names([username])[username]
 
-        idx = 0
-        is_active = False
-        for record in result['records']:
-            if record['pse__Is_Resource__c'] == True and record['pse__Is_Resource_Active__c']:
-                is_active = True
-                break
-            idx = idx + 1
-        
-        if is_active == True:
-            return {'is_active': is_active, 'Id': result['records'][idx]['Id'],
-                    'Name': result['records'][idx]['Name']}
-        return {'is_active': is_active, 'Id': username}
+    def get_task_assignments(self, task_ids):
+        """
+            Returns {task id: first assignment} for every task with chunked IN (...) queries
+        """
+        assignments = {}
+        for chunk in chunks(sorted(set(task_ids)), SOQL_IN_CHUNK_SIZE):
+            records = self.query("select Id, pse__Project_Task__c, pse__Resource__c, pse__External_Resource__c \
+                from pse__Project_Task_Assignment__c where pse__Project_Task__c in {}", chunk)
+            for record in records:
+                if record['pse__Project_Task__c'] not in assignments:
+                    assignments[record['pse__Project_Task__c']] = record
+        return assignments
 
     def task_exist_in_assignment(self, task_id):
-        result = self.sf.query("select Id, Name, pse__Resource__c from pse__Project_Task_Assignment__c \
-                                where pse__Project_Task__c='{}'".format(task_id))
+        assignment = next(self.query("select Id, Name, pse__Resource__c from pse__Project_Task_Assignment__c \
+                                where pse__Project_Task__c={} limit 1", task_id), None)
 
-        if result['totalSize'] == 0:
+        if assignment is None:
             return { 'is_exist': False }
 
         return {'is_exist': True,
-                'Id': result['records'][0]['Id'],
-                'resource_id': result['records'][0]['pse__Resource__c']}
+                'Id': assignment['Id'],
+                'resource_id': assignment['pse__Resource__c']}
 
     def format_time(self, time_val):
         if time_val is None:
@@ -660,14 +3050,14 @@ class ScheduleBot:
             return None
         return val.split("-")[0].strip()
 
-    def upload(self, file, channel):
+    def upload(self, file, channel, title="Test upload"):
         try:
             with open(file) as file_content:
                 res = self.slack_client.api_call(
                         "files.upload",
                         channels=channel,
                         file=file_content,
-                        title="Test upload"
+                        title=title
                     )
 
                 file_content.close()
@@ -675,109 +3065,94 @@ class ScheduleBot:
             self.slack_client.api_call(
                 "chat.postMessage",
                 channel=channel,
-                text=e.message
+                text=str(e)
             )
 
         return True
 
     def get_tasks_by_weeks(self, channel):
         float_api = FloatAPI()
+        fieldnames = ["start_date"] + self.classifier.names
+
+        # from the first day of last month to the last day of next month
+        today = date.today()
+        start_date_of_month = (today - dateutil.relativedelta.relativedelta(months=1)).replace(day=1)
+        start_next_month = (today + dateutil.relativedelta.relativedelta(months=2)).replace(day=1)
+        last_date_of_month = start_next_month - timedelta(days=1)
+        weeks = get_week_starts(start_date_of_month, last_date_of_month)
+        if len(weeks) == 0:
+            return
+
+        start_date = weeks[0].strftime("%Y-%m-%d")
+        end_date = (weeks[-1] + timedelta(days=6)).strftime("%Y-%m-%d")
+
+        # past weeks don't change anymore and come from the cache,
+        # the current and future weeks are always fetched again
+        snapshot = SnapshotStore()
+        cached_weeks = snapshot.get_report_weeks(weeks, self.classifier.version)
+        stale_weeks = [week_start for week_start in weeks
+                       if week_start not in cached_weeks or week_start + timedelta(days=6) >= today]
+
+        if len(stale_weeks) > 0:
+            # one paginated fetch for the stale range, bucketed into weeks in memory
+            schedule_tasks = float_api.get_tasks_by_params('start_date={}&end_date={}'.format(
+                stale_weeks[0].strftime("%Y-%m-%d"), (stale_weeks[-1] + timedelta(days=6)).strftime("%Y-%m-%d")))
+            tasks_by_week = bucket_tasks_by_week(schedule_tasks, stale_weeks)
+
+            # every task is classified once even if it spans several weeks
+            task_categories = dict(
+                (task["task_id"], categories) for task, categories in
+                zip(schedule_tasks, self.classifier.classify(schedule_tasks, float_api.get_project_name)))
+
+            fetched_weeks = {}
+            for week_start in stale_weeks:
+                counts = dict((name, 0) for name in self.classifier.names)
+                for schedule_task in tasks_by_week[week_start]:
+                    for category in task_categories[schedule_task["task_id"]]:
+                        counts[category] = counts[category] + 1
+                fetched_weeks[week_start] = {"tasks": len(tasks_by_week[week_start]), "counts": counts}
+
+            # only finished weeks are worth keeping
+            snapshot.save_report_weeks(dict(
+                (week_start, week) for week_start, week in fetched_weeks.items()
+                if week_start + timedelta(days=6) < today), self.classifier.version)
+            cached_weeks.update(fetched_weeks)
+        snapshot.close()
+
         report_schedules = []
-        fieldnames = [
-            "start_date",
-            "on_vocation",
-            "in_training_for_teaching",
-            "in_training_for_learning",
-            "onsite_go_live",
-            "onsite_setup",
-            "remote_training"
-        ]
-
-        # create csv file with header
-        with open('report.csv', 'w') as csv_file:
+        number_of_tasks = 0
+        for week_start in weeks:
+            week = cached_weeks[week_start]
+            if week["tasks"] > 0:
+                number_of_tasks = number_of_tasks + week["tasks"]
+                report_schedule = dict(week["counts"])
+                report_schedule["start_date"] = week_start.strftime("%Y-%m-%d")
+                report_schedules.append(report_schedule)
+
+        # every report gets its own file, so concurrent reports don't overwrite each other
+        if not os.path.isdir(REPORTS_DIR):
+            os.makedirs(REPORTS_DIR)
+        report_str = os.path.join(REPORTS_DIR, 'report-{}-{}.csv'.format(start_date, uuid.uuid4().hex))
+        with open(report_str, 'w') as csv_file:
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
             writer.writeheader()
+            writer.writerows(report_schedules)
 
-        year = datetime.now().strftime("%Y")
-        month = datetime.now().strftime("%m")
-        next_month = datetime.now() + dateutil.relativedelta.relativedelta(months=2)
-        before_month = datetime.now() - dateutil.relativedelta.relativedelta(months=1)
-
-        start_next_month = datetime.strptime(
-            '{}-{}-1'.format(year, next_month.strftime("%m")),
-            '%Y-%m-%d'
-        )
-        start_date_of_month = datetime.strptime(
-            '{}-{}-1'.format(year, before_month.strftime("%m")),
-            '%Y-%m-%d'
+        self.slack_client.api_call(
+            "chat.postMessage",
+            channel=channel,
+            text='Get tasks: {} ~ {}, {} tasks in {} weeks ({} weeks from cache)'.format(
+                start_date, end_date, number_of_tasks, len(report_schedules), len(weeks) - len(stale_weeks))
         )
-
-        last_date_of_month = start_next_month  - timedelta(days=1)
-        start_weeknum = start_date_of_month.strftime("%V")
-        end_weeknum = last_date_of_month.strftime("%V")
-
-        for week_num in range(int(start_weeknum), int(end_weeknum)):
-            date_obj = get_start_end_dates(2019, week_num)
-            start_date = date_obj["start_datetime"].strftime("%Y-%m-%d")
-            end_date = date_obj["end_datetime"].strftime("%Y-%m-%d")
-
-            schedule_tasks = float_api.get_tasks_by_params(
-                'start_date={}&end_date={}'.format(start_date, end_date)
-            )
-            if len(schedule_tasks) > 0:
-                with open('report.csv', 'a') as csv_file:
-                    writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-
-                    report_schedule = {
-                        "start_date": start_date,
-                        "on_vocation": 0,
-                        "in_training_for_teaching": 0,
-                        "in_training_for_learning": 0,
-                        "onsite_go_live": 0,
-                        "onsite_setup": 0,
-                        "remote_training": 0
-                    }
-
-                    for schedule_task in schedule_tasks:
-                        if "paid time off" in schedule_task["name"].lower():
-                            report_schedule["on_vocation"] = report_schedule["on_vocation"] + 1
-
-                        if "one on one" in schedule_task["name"].lower():
-                            project_item = float_api.get_project_by_id(schedule_task["project_id"])
-                            if project_item["name"] is not None:
-                                if "trainer" in project_item["name"].lower():
-                                    report_schedule["in_training_for_teaching"] = report_schedule["in_training_for_teaching"] + 1
-                                if "trainee" in project_item["name"].lower():
-                                    report_schedule["in_training_for_learning"] = report_schedule["in_training_for_learning"] + 1
-
-                        if "remote enduser" in schedule_task["name"].lower():
-                            report_schedule["remote_training"] = report_schedule["remote_training"] + 1
-
-                        if "enduser" in schedule_task["name"].lower():
-                            report_schedule["onsite_setup"] = report_schedule["onsite_setup"] + 1
-                    
-                        if "go live" in schedule_task["name"].lower():
-                            report_schedule["onsite_go_live"] = report_schedule["onsite_go_live"] + 1
-
-                    self.slack_client.api_call(
-                        "chat.postMessage",
-                        channel=channel,
-                        text='Get tasks: {} ~ {}'.format(start_date, end_date)
-                    )
-                    writer.writerow({
-                        "start_date": report_schedule["start_date"],
-                        "on_vocation": report_schedule["on_vocation"],
-                        "in_training_for_teaching": report_schedule["in_training_for_teaching"],
-                        "in_training_for_learning": report_schedule["in_training_for_learning"],
-                        "onsite_go_live": report_schedule["onsite_go_live"],
-                        "onsite_setup": report_schedule["onsite_setup"],
-                        "remote_training": report_schedule["remote_training"],
-                    })
-                    csv_file.close()
-
-        self.upload('report.csv', channel)
+        self.upload(report_str, channel)
 
 
 if __name__ == "__main__":
     bot = ScheduleBot()
-    bot.run()
+    if len(sys.argv) > 1 and sys.argv[1] == 'events':
+        bot.serve_events()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        # sync worker: claims shards of `sync <session id> shards <n>` runs
+        bot.work_shards()
+    else:
+        bot.run()